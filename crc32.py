@@ -1,35 +1,149 @@
 import argparse
+import string
 import sys
-import zlib
+import threading
 
 from voussoirkit import pathclass
 from voussoirkit import pipeable
+from voussoirkit import threadpool
 from voussoirkit import vlogging
 
+import hashcache
+
 log = vlogging.getLogger(__name__, 'crc32')
 
+def read_sfv(sfv_file):
+    '''
+    Return a list of (file, crc) from an sfv file. Relative paths are relative
+    to the sfv file's directory.
+    '''
+    sfv_file = pathclass.Path(sfv_file)
+    entries = []
+    lines = sfv_file.read('r', encoding='utf-8').splitlines()
+    for (number, line) in enumerate(lines, start=1):
+        line = line.strip()
+        if not line or line.startswith(';'):
+            continue
+
+        (name, _, crc) = line.rpartition(' ')
+        name = name.strip()
+        crc = crc.lower()
+        if not name or len(crc) != 8 or any(char not in string.hexdigits for char in crc):
+            log.error('%s line %d is not a valid sfv line: %s', sfv_file.absolute_path, number, line)
+            continue
+
+        entries.append((sfv_file.parent.join(name), crc))
+    return entries
+
+def write_sfv(sfv_file, entries):
+    '''
+    Write a list of (file, crc) to an sfv file. Files underneath the sfv
+    file's directory are written as relative paths so the folder can be moved
+    and verified somewhere else.
+    '''
+    sfv_file = pathclass.Path(sfv_file)
+    lines = []
+    for (file, crc) in entries:
+        if file in sfv_file.parent:
+            name = file.relative_to(sfv_file.parent, simple=True)
+        else:
+            name = file.absolute_path
+        lines.append(f'{name} {crc.upper()}\n')
+
+    with sfv_file.open('w', encoding='utf-8') as handle:
+        handle.writelines(lines)
+
+def _verify_one(file, crc):
+    if not file.is_file:
+        return 'MISSING'
+    # Bit rot doesn't change the mtime, so we must not trust the cache here.
+    actual = hashcache.hash_file(file, 'crc32', cache=False)
+    return 'OK' if actual == crc else f'FAILED {actual}'
+
+def verify(entries, jobs=1):
+    '''
+    Check each file against its crc, using a pool of `jobs` threads. zlib
+    releases the GIL while hashing so the files really are read in parallel.
+
+    Yields (file, crc, status) in the same order as the entries.
+    '''
+    if not entries:
+        return
+
+    # If the consumer stops early, this stops the pool from starting any more
+    # files, and the finally lets the ones already started run out so that no
+    # thread is left blocked on the full buffer.
+    stop = threading.Event()
+
+    def job_generator():
+        for (file, crc) in entries:
+            if stop.is_set():
+                break
+            yield {'function': _verify_one, 'args': [file, crc]}
+
+    pool = threadpool.ThreadPool(jobs, paused=True)
+    pool.add_generator(job_generator())
+    results = pool.result_generator(buffer_size=jobs * 4)
+    try:
+        for job in results:
+            (file, crc) = job.args
+            if job.exception:
+                yield (file, crc, f'ERROR {job.exception}')
+            else:
+                yield (file, crc, job.value)
+    finally:
+        stop.set()
+        for job in results:
+            pass
+        # The result_generator leaves the pool paused, and the threads need
+        # to be running to notice that it has closed.
+        pool.close()
+        pool.start()
+
 def crc32_argparse(args):
     return_status = 0
 
+    if args.verify:
+        for (file, crc, status) in verify(read_sfv(args.verify), jobs=args.jobs):
+            if status != 'OK':
+                return_status = 1
+            pipeable.stdout(f'{status} {file.absolute_path}')
+        return return_status
+
+    if not args.patterns:
+        raise ValueError('Provide some patterns, or --verify an sfv file.')
+
+    if args.hash_cache:
+        hashcache.CACHE.open_database(args.hash_cache)
+
     patterns = pipeable.input_many(args.patterns, skip_blank=True, strip=True)
     files = pathclass.glob_many_files(patterns)
 
+    entries = []
     for file in files:
         try:
-            crc = zlib.crc32(file.read('rb'))
-            crc = hex(crc)[2:].rjust(8, '0')
+            crc = hashcache.hash_file(file, 'crc32')
             pipeable.stdout(f'{crc} {file.absolute_path}')
+            entries.append((file, crc))
         except Exception as e:
             log.error('%s %s', file, e)
             return_status = 1
 
+    if args.sfv:
+        write_sfv(args.sfv, entries)
+
+    hashcache.CACHE.prune()
     return return_status
 
 @vlogging.main_decorator
 def main(argv):
     parser = argparse.ArgumentParser(description=__doc__)
 
-    parser.add_argument('patterns', nargs='+')
+    parser.add_argument('patterns', nargs='*')
+    parser.add_argument('--hash_cache', '--hash-cache', default=None)
+    parser.add_argument('--sfv', default=None)
+    parser.add_argument('--verify', default=None)
+    parser.add_argument('--jobs', type=int, default=1)
     parser.set_defaults(func=crc32_argparse)
 
     args = parser.parse_args(argv)
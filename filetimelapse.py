@@ -5,38 +5,23 @@ Not a replacement for real version control but could be applicable in very
 simple situations or in cases where e.g. git is not.
 '''
 import argparse
-import hashlib
 import os
 import shutil
 import sys
 import time
 
-from voussoirkit import bytestring
 from voussoirkit import pathclass
 from voussoirkit import winglob
 
-def hash_file(filepath, hasher):
-    bytestream = read_filebytes(filepath)
-    for chunk in bytestream:
-        hasher.update(chunk)
-    return hasher.hexdigest()
+import hashcache
 
 def hash_file_md5(filepath):
-    return hash_file(filepath, hasher=hashlib.md5())
-
-def read_filebytes(filepath, chunk_size=bytestring.MEBIBYTE):
+    # Between changes, the cache lets us check the file with just a stat
+    # instead of reading it every time.
     filepath = pathclass.Path(filepath)
     if not filepath.is_file:
         raise FileNotFoundError(filepath)
-
-    f = filepath.open('rb')
-    with f:
-        while True:
-            chunk = f.read(chunk_size)
-            if len(chunk) == 0:
-                break
-
-            yield chunk
+    return hashcache.hash_file(filepath, 'md5')
 
 def filetimelapse(filepath, rate):
     (noext, extension) = os.path.splitext(filepath)
@@ -1,34 +1,284 @@
 import argparse
 import hashlib
+import itertools
+import json
 import os
 import send2trash
 import sys
+import threading
+
+import hashcache
 
 from voussoirkit import bytestring
 from voussoirkit import lazychain
 from voussoirkit import pathclass
 from voussoirkit import pipeable
+from voussoirkit import threadpool
 from voussoirkit import vlogging
 
 log = vlogging.getLogger(__name__, 'hash_hardlink')
 
+# The partial hash reads this many bytes from each end of the file.
+PARTIAL_HASH_SIZE = 2 ** 16
+
 def hash_file(file):
+    return hashcache.hash_file(file, 'md5')
+
+def hash_file_partial(file):
+    '''
+    Hash the first and last PARTIAL_HASH_SIZE bytes of the file. For files
+    that are no bigger than that, this is the same as the full hash.
+    '''
+    if file.size <= 2 * PARTIAL_HASH_SIZE:
+        return hash_file(file)
+
+    stat = file.stat
+    algorithm = f'md5-partial-{PARTIAL_HASH_SIZE}'
+    h = hashcache.CACHE.get(stat, algorithm)
+    if h is not None:
+        return h
+
     hasher = hashlib.md5()
     with file.open('rb') as handle:
-        while True:
-            chunk = handle.read(2**20)
-            if not chunk:
-                break
-            hasher.update(chunk)
-    return hasher.hexdigest()
+        hasher.update(handle.read(PARTIAL_HASH_SIZE))
+        handle.seek(-PARTIAL_HASH_SIZE, os.SEEK_END)
+        hasher.update(handle.read(PARTIAL_HASH_SIZE))
+    h = hasher.hexdigest()
+    hashcache.CACHE.set(stat, algorithm, h)
+    return h
+
+def group_by_size(files):
+    '''
+    Return a dict of {size: [files]} containing only the sizes that have more
+    than one file. Files that are already hardlinks of each other are counted
+    once.
+    '''
+    inodes = set()
+    groups = {}
+    for file in files:
+        stat = file.stat
+        inode = (stat.st_dev, stat.st_ino)
+        if inode in inodes:
+            # This file is already a hardlink of another file we've seen.
+            continue
+        inodes.add(inode)
+        groups.setdefault(file.size, []).append(file)
+
+    return {size: files for (size, files) in groups.items() if len(files) > 1}
+
+def _hash_on_device(file, hash_function, semaphore):
+    with semaphore:
+        return hash_function(file)
+
+def hash_many(files, hash_function, jobs=1, device_jobs=None):
+    '''
+    Return a dict of {file: hash}, using a pool of `jobs` threads. hashlib and
+    zlib release the GIL while hashing, so the threads really do run at the
+    same time.
+
+    device_jobs:
+        The number of threads that may read from the same device at once.
+        With spinning disks, use 1 so that the threads hash files from
+        different disks instead of making one disk seek back and forth.
+        If None, there is no limit besides `jobs`.
+    '''
+    if jobs == 1 or len(files) < 2:
+        return {file: hash_function(file) for file in files}
+
+    by_device = {}
+    for file in files:
+        stat = file.stat
+        by_device.setdefault(stat.st_dev, []).append((stat.st_ino, file))
+
+    semaphores = {device: threading.BoundedSemaphore(device_jobs or jobs) for device in by_device}
+
+    # Within each device, reading in inode order tends to follow the layout
+    # of the disk. Between devices, we take turns, so that the threads are
+    # spread across all of the devices instead of queueing up on the first.
+    queues = []
+    for (device, device_files) in by_device.items():
+        device_files.sort(key=lambda pair: pair[0])
+        queues.append([(file, semaphores[device]) for (inode, file) in device_files])
+
+    kwargss = []
+    for row in itertools.zip_longest(*queues):
+        kwargss.extend(
+            {'function': _hash_on_device, 'args': [file, hash_function, semaphore]}
+            for (file, semaphore) in filter(None, row)
+        )
+
+    pool = threadpool.ThreadPool(jobs, paused=True)
+    pool.add_many(kwargss)
+    hashes = {}
+    try:
+        for job in pool.result_generator():
+            if job.exception:
+                raise job.exception
+            hashes[job.args[0]] = job.value
+    finally:
+        pool.close()
+        # The result_generator leaves the pool paused, and the threads need
+        # to be running to notice that it has closed.
+        pool.start()
+    return hashes
+
+def group_by_hash(groups, hash_function, jobs=1, device_jobs=None):
+    '''
+    Split each group of files by their hash, and return a dict of
+    {(size, hash): [files]} containing only the hashes that have more than one
+    file.
+    '''
+    files = [file for files in groups.values() for file in files]
+    hashes = hash_many(files, hash_function, jobs=jobs, device_jobs=device_jobs)
+
+    new_groups = {}
+    for file in files:
+        h = hashes[file]
+        log.debug('%s %s', file.absolute_path, h)
+        new_groups.setdefault((file.size, h), []).append(file)
+
+    return {key: files for (key, files) in new_groups.items() if len(files) > 1}
+
+def find_duplicates(files, jobs=1, device_jobs=None):
+    '''
+    Return a dict of {(size, hash): [files]} for the files that have the same
+    content. Rather than hashing everything, we first compare the sizes, then
+    hash the beginning and end of the files whose sizes match, and only then
+    hash the whole file for the ones that are still in the running.
+    '''
+    groups = group_by_size(files)
+    log.info('%d files have matching sizes.', sum(len(files) for files in groups.values()))
+
+    groups = group_by_hash(groups, hash_file_partial, jobs=jobs, device_jobs=device_jobs)
+    log.info('%d files have matching partial hashes.', sum(len(files) for files in groups.values()))
+
+    # The partial hash of a small file already covers the whole file.
+    large = {key: files for (key, files) in groups.items() if key[0] > 2 * PARTIAL_HASH_SIZE}
+    for key in large:
+        groups.pop(key)
+    groups.update(group_by_hash(large, hash_file, jobs=jobs, device_jobs=device_jobs))
+
+    for ((size, h), files) in groups.items():
+        for file in files:
+            print(file.absolute_path, h)
+
+    return groups
+
+def split_by_device(duplicates):
+    '''
+    Hardlinks can't cross devices, so split each group of duplicates from
+    find_duplicates by device, and return a dict of {(size, hash): [[files]]}
+    containing only the device groups that have more than one file.
+    '''
+    linkable = {}
+    for (key, files) in duplicates.items():
+        by_device = {}
+        for file in files:
+            by_device.setdefault(file.stat.st_dev, []).append(file)
+        device_groups = [files for files in by_device.values() if len(files) > 1]
+        if device_groups:
+            linkable[key] = device_groups
+    return linkable
+
+def make_report(duplicates):
+    '''
+    Return a JSON-friendly dict of the duplicate groups, which can be saved
+    and given to apply_report later. Each group is on a single device, since
+    that's what can be linked.
+
+    Each file's device, inode, size, and mtime are recorded so that
+    apply_report can tell if the file has changed in the meantime without
+    hashing it again.
+
+    A follower's bytes are only reclaimable if the leader is its last link.
+    If it has other hardlinks outside of the scanned paths, linking it to the
+    leader doesn't free anything.
+    '''
+    groups = []
+    for ((size, h), device_groups) in split_by_device(duplicates).items():
+        for files in device_groups:
+            entries = []
+            for file in files:
+                stat = file.stat
+                entries.append({
+                    'path': file.absolute_path,
+                    'device': stat.st_dev,
+                    'inode': stat.st_ino,
+                    'mtime_ns': stat.st_mtime_ns,
+                    'nlink': stat.st_nlink,
+                })
+            reclaimable = sum(size for entry in entries[1:] if entry['nlink'] == 1)
+            groups.append({
+                'size': size,
+                'hash': h,
+                'reclaimable_bytes': reclaimable,
+                'files': entries,
+            })
+
+    groups.sort(key=lambda group: group['reclaimable_bytes'], reverse=True)
+    return {
+        'groups': groups,
+        'duplicate_files': sum(len(group['files']) - 1 for group in groups),
+        'reclaimable_bytes': sum(group['reclaimable_bytes'] for group in groups),
+    }
+
+def hardlink(leader, follower):
+    print(f'{leader.absolute_path} -> {follower.absolute_path}')
+    send2trash.send2trash(follower.absolute_path)
+    os.link(leader.absolute_path, follower.absolute_path)
+
+def apply_report(report):
+    '''
+    Hardlink the duplicates from a report made by make_report, without
+    hashing them again. Files that have been modified, replaced, or already
+    linked since the report was made are skipped.
+    '''
+    def unchanged(entry, size):
+        try:
+            stat = os.stat(entry['path'])
+        except FileNotFoundError:
+            return False
+        return (
+            stat.st_dev == entry['device'] and
+            stat.st_ino == entry['inode'] and
+            stat.st_size == size and
+            stat.st_mtime_ns == entry['mtime_ns']
+        )
+
+    for group in report['groups']:
+        (leader, *followers) = group['files']
+        if not unchanged(leader, group['size']):
+            log.warning('%s has changed since the report, skipping its group.', leader['path'])
+            continue
+
+        for follower in followers:
+            try:
+                stat = os.stat(follower['path'])
+            except FileNotFoundError:
+                stat = None
+            # Inode numbers are only unique within a device.
+            if stat is not None and (stat.st_dev, stat.st_ino) == (leader['device'], leader['inode']):
+                log.debug('%s is already linked.', follower['path'])
+                continue
+            if not unchanged(follower, group['size']):
+                log.warning('%s has changed since the report, skipping.', follower['path'])
+                continue
+            hardlink(pathclass.Path(leader['path']), pathclass.Path(follower['path']))
 
 @pipeable.ctrlc_return1
 def hash_hardlink_argparse(args):
+    if args.apply:
+        with open(args.apply, 'r', encoding='utf-8') as handle:
+            apply_report(json.load(handle))
+        return 0
+
+    if not args.patterns:
+        raise ValueError('Provide some patterns, or --apply a report.')
+
     patterns = pipeable.input_many(args.patterns, strip=True, skip_blank=True)
     paths = list(pathclass.glob_many(patterns))
-    drives = set(path.stat.st_dev for path in paths)
-    if len(drives) != 1:
-        raise ValueError('All paths must be on the same drive.')
+    if args.hash_cache:
+        hashcache.CACHE.open_database(args.hash_cache)
 
     files = lazychain.LazyChain()
     for path in paths:
@@ -39,26 +289,25 @@ def hash_hardlink_argparse(args):
 
     files = (file for file in files if file.size >= args.if_larger_than)
 
-    inodes = set()
-    hashes = {}
-
-    for file in files:
-        if file.stat.st_ino in inodes:
-            # This file is already a hardlink of another file we've seen.
-            continue
-        inodes.add(file.stat.st_ino)
-        h = hash_file(file)
-        print(file.absolute_path, h)
-        hashes.setdefault(h, []).append(file)
+    duplicates = find_duplicates(files, jobs=args.jobs, device_jobs=args.device_jobs)
+    hashcache.CACHE.prune()
 
-    hashes = {h: files for (h, files) in hashes.items() if len(files) > 1}
+    if args.report:
+        report = make_report(duplicates)
+        with open(args.report, 'w', encoding='utf-8') as handle:
+            json.dump(report, handle, indent=4)
+        log.info(
+            '%d duplicate files, %s reclaimable.',
+            report['duplicate_files'],
+            bytestring.bytestring(report['reclaimable_bytes']),
+        )
+        return 0
 
-    for (h, files) in hashes.items():
-        leader = files.pop(0)
-        for follower in files:
-            print(f'{leader.absolute_path} -> {follower.absolute_path}')
-            send2trash.send2trash(follower.absolute_path)
-            os.link(leader.absolute_path, follower.absolute_path)
+    for device_groups in split_by_device(duplicates).values():
+        for files in device_groups:
+            (leader, *followers) = files
+            for follower in followers:
+                hardlink(leader, follower)
 
     return 0
 
@@ -66,8 +315,13 @@ def hash_hardlink_argparse(args):
 def main(argv):
     parser = argparse.ArgumentParser(description=__doc__)
 
-    parser.add_argument('patterns', nargs='+')
+    parser.add_argument('patterns', nargs='*')
     parser.add_argument('--if_larger_than', '--if-larger-than', type=bytestring.parsebytes, default=-1)
+    parser.add_argument('--hash_cache', '--hash-cache', default=None)
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--device_jobs', '--device-jobs', type=int, default=None)
+    parser.add_argument('--report', default=None)
+    parser.add_argument('--apply', default=None)
     parser.set_defaults(func=hash_hardlink_argparse)
 
     args = parser.parse_args(argv)
@@ -0,0 +1,206 @@
+'''
+hashcache
+=========
+
+A persistent cache of file content hashes, shared by hash_hardlink, crc32, and
+filetimelapse.
+
+Entries are keyed by the file's device and inode, and are only used if the
+file's size and mtime haven't changed since it was hashed. Renaming or
+hardlinking a file doesn't lose its entry, and a repeat pass over a mostly
+unchanged tree costs one stat per file instead of reading all of the data.
+
+By default the cache is kept in memory and forgotten when the program exits.
+Use open_database to keep it on disk.
+'''
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from voussoirkit import pathclass
+from voussoirkit import vlogging
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+log = vlogging.getLogger(__name__, 'hashcache')
+
+CHUNK_SIZE = 2 ** 20
+
+# The least recently used entries beyond this many are evicted by prune.
+MAX_ENTRIES = 1_000_000
+
+# Entries that haven't been used in this many seconds are evicted by prune.
+MAX_AGE = 180 * 86400
+
+# We don't need to write last_used every single time an entry is read, as
+# long as it's roughly right for prune.
+LAST_USED_RESOLUTION = 86400
+
+HASHCACHE_DB_INIT = '''
+BEGIN;
+CREATE TABLE IF NOT EXISTS hashes(
+    device INT NOT NULL,
+    inode INT NOT NULL,
+    algorithm TEXT NOT NULL,
+    size INT NOT NULL,
+    mtime_ns INT NOT NULL,
+    hash TEXT NOT NULL,
+    last_used INT NOT NULL,
+    PRIMARY KEY(device, inode, algorithm)
+);
+CREATE INDEX IF NOT EXISTS index_hashes_last_used on hashes(last_used);
+COMMIT;
+'''
+
+class CRC32:
+    '''
+    zlib.crc32 with the same interface as the hashlib objects.
+    '''
+    def __init__(self):
+        self.crc = 0
+
+    def update(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+
+    def hexdigest(self):
+        return f'{self.crc:08x}'
+
+ALGORITHMS = {
+    'blake2b': hashlib.blake2b,
+    'blake2s': hashlib.blake2s,
+    'crc32': CRC32,
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+}
+if xxhash is not None:
+    ALGORITHMS['xxh64'] = xxhash.xxh64
+    ALGORITHMS['xxh3_128'] = xxhash.xxh3_128
+
+def new_hasher(algorithm):
+    try:
+        return ALGORITHMS[algorithm]()
+    except KeyError:
+        raise ValueError(f'Unknown hash algorithm {algorithm}, expected one of {sorted(ALGORITHMS)}.')
+
+def hash_file(file, algorithm='md5', *, cache=None, chunk_size=CHUNK_SIZE):
+    '''
+    Return the hexdigest of the file's content, reading it chunk by chunk so
+    that memory use doesn't depend on the file size.
+
+    cache:
+        A HashCache. If the file hasn't changed since it was last hashed with
+        this algorithm, we don't read it at all. If None, the module's global
+        CACHE is used. Pass False to skip the cache.
+    '''
+    file = pathclass.Path(file)
+    if cache is None:
+        cache = CACHE
+
+    if cache is not False:
+        return cache.hash_file(file, algorithm, chunk_size=chunk_size)
+
+    hasher = new_hasher(algorithm)
+    with file.open('rb') as handle:
+        while True:
+            chunk = handle.read(chunk_size)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+class HashCache:
+    def __init__(self, max_age=MAX_AGE, max_entries=MAX_ENTRIES):
+        self.max_age = max_age
+        self.max_entries = max_entries
+        # With hash_hardlink --jobs, several threads can be hashing at once.
+        self.lock = threading.Lock()
+        self.open_database(':memory:')
+
+    def open_database(self, path):
+        if isinstance(path, pathclass.Path):
+            path = path.absolute_path
+        self.sql = sqlite3.connect(path, check_same_thread=False)
+        # It's only a cache. If it gets lost, we just hash the files again.
+        self.sql.execute('PRAGMA synchronous = OFF')
+        self.sql.executescript(HASHCACHE_DB_INIT)
+
+    def get(self, stat, algorithm):
+        '''
+        Return the cached hash for the file with this os.stat result, or None
+        if it was never hashed or has changed since.
+
+        The algorithm is just a name, so callers can also cache things like
+        partial hashes by giving them a name of their own.
+        '''
+        with self.lock:
+            cur = self.sql.execute(
+                '''
+                SELECT hash, last_used FROM hashes
+                WHERE device == ? AND inode == ? AND algorithm == ? AND size == ? AND mtime_ns == ?
+                ''',
+                [stat.st_dev, stat.st_ino, algorithm, stat.st_size, stat.st_mtime_ns]
+            )
+            row = cur.fetchone()
+            if row is None:
+                return None
+
+            (h, last_used) = row
+            now = int(time.time())
+            if now - last_used > LAST_USED_RESOLUTION:
+                self.sql.execute(
+                    'UPDATE hashes SET last_used = ? WHERE device == ? AND inode == ? AND algorithm == ?',
+                    [now, stat.st_dev, stat.st_ino, algorithm]
+                )
+                self.sql.commit()
+            return h
+
+    def set(self, stat, algorithm, h):
+        with self.lock:
+            self.sql.execute(
+                'INSERT OR REPLACE INTO hashes VALUES(?, ?, ?, ?, ?, ?, ?)',
+                [stat.st_dev, stat.st_ino, algorithm, stat.st_size, stat.st_mtime_ns, h, int(time.time())]
+            )
+            self.sql.commit()
+
+    def hash_file(self, file, algorithm='md5', *, chunk_size=CHUNK_SIZE):
+        file = pathclass.Path(file)
+        # Take the stat before reading, so that if the file is modified while
+        # we're hashing it, the entry is already stale and gets redone.
+        stat = os.stat(file)
+        h = self.get(stat, algorithm)
+        if h is not None:
+            log.loud('Cache hit %s %s.', algorithm, file.absolute_path)
+            return h
+
+        h = hash_file(file, algorithm, cache=False, chunk_size=chunk_size)
+        self.set(stat, algorithm, h)
+        return h
+
+    def prune(self):
+        '''
+        Evict the entries that haven't been used in max_age seconds, then the
+        least recently used entries beyond max_entries.
+        '''
+        with self.lock:
+            if self.max_age is not None:
+                self.sql.execute('DELETE FROM hashes WHERE last_used < ?', [time.time() - self.max_age])
+
+            if self.max_entries is not None:
+                self.sql.execute(
+                    '''
+                    DELETE FROM hashes WHERE rowid IN (
+                        SELECT rowid FROM hashes ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                    )
+                    ''',
+                    [self.max_entries]
+                )
+            self.sql.commit()
+
+CACHE = HashCache()
@@ -2,14 +2,27 @@ import argparse
 import hashlib
 import os
 import re
+import socket
+import sqlite3
+import subprocess
 import sys
+import threading
 import time
 import traceback
+import uuid
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
 
 # make this on your pythonpath like this:
 # EXTENSION_COMMANDS = {
 #     'ytqueue': ('youtube-dl', '{id}'),
 # }
+# and optionally, to cap how many of each extension run at once with --workers:
+# EXTENSION_LIMITS = {
+#     'ytqueue': 3,
+# }
 import qcommands
 
 from voussoirkit import backoff
@@ -17,22 +30,441 @@ from voussoirkit import betterhelp
 from voussoirkit import dotdict
 from voussoirkit import operatornotify
 from voussoirkit import pathclass
+from voussoirkit import threadpool
 from voussoirkit import vlogging
 
 log = vlogging.getLogger(__name__, 'q')
+vlogging.getLogger('threadpool').setLevel(vlogging.WARNING)
+
+# Between scans, queue_forever waits for the FolderWatcher to report a change.
+# We still rescan this often regardless, in case a change went unnoticed, such
+# as files written onto a network share by another machine, which inotify does
+# not see.
+RESCAN_INTERVAL = 600
+
+# With --claim, each folder gets a directory of this name to hold the claims.
+CLAIMS_DIRECTORY = '.qclaims'
+
+JOURNAL_DB_INIT = '''
+BEGIN;
+CREATE TABLE IF NOT EXISTS queuefiles(
+    path TEXT PRIMARY KEY NOT NULL,
+    extension TEXT NOT NULL,
+    failures INT NOT NULL,
+    next_eligible REAL NOT NULL,
+    blacklisted INT NOT NULL,
+    reason TEXT
+);
+CREATE TABLE IF NOT EXISTS attempts(
+    path TEXT NOT NULL,
+    extension TEXT NOT NULL,
+    started REAL NOT NULL,
+    duration REAL NOT NULL,
+    exit_code INT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS index_attempts_extension on attempts(extension);
+COMMIT;
+'''
+
+class Journal:
+    '''
+    Keeps a record of every attempt at processing a queuefile, and which files
+    are in time out or blacklisted.
+
+    Each file gets an individual backoff when it encounters an error, so we
+    can continue processing other files and come back to the problematic ones
+    later, with increasing timeouts. If a file demonstrates unrecoverable
+    errors, we blacklist it and never touch it again. If the file ever
+    disappears then it is removed from the time out and the blacklist, but its
+    attempts are kept for the statistics.
+
+    By default the journal is kept in memory and forgotten when the program
+    exits. Use open_database to keep it on disk so that restarts remember
+    which files are in time out.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.open_database(':memory:')
+
+    def open_database(self, path):
+        self.sql = sqlite3.connect(path, check_same_thread=False)
+        self.sql.executescript(JOURNAL_DB_INIT)
+
+    def add_attempt(self, file, started, duration, exit_code):
+        with self.lock:
+            self.sql.execute(
+                'INSERT INTO attempts VALUES(?, ?, ?, ?, ?)',
+                [file.absolute_path, file.extension.no_dot.lower(), started, duration, exit_code]
+            )
+            self.sql.commit()
+
+    def blacklist(self, file, reason=''):
+        with self.lock:
+            self.sql.execute(
+                '''
+                INSERT INTO queuefiles VALUES(?, ?, 0, 0, 1, ?)
+                ON CONFLICT(path) DO UPDATE SET blacklisted = 1, reason = excluded.reason
+                ''',
+                [file.absolute_path, file.extension.no_dot.lower(), reason]
+            )
+            self.sql.commit()
+
+    def clear(self, file):
+        '''
+        Forget the time out of a file that has been processed successfully.
+        '''
+        with self.lock:
+            self.sql.execute('DELETE FROM queuefiles WHERE path == ?', [file.absolute_path])
+            self.sql.commit()
+
+    def get_failures(self, file):
+        with self.lock:
+            cur = self.sql.execute('SELECT failures FROM queuefiles WHERE path == ?', [file.absolute_path])
+            row = cur.fetchone()
+        return 0 if row is None else row[0]
+
+    def get_next_eligible(self):
+        '''
+        Return the timestamp at which the next file comes out of time out, or
+        None if there are none in time out.
+        '''
+        with self.lock:
+            cur = self.sql.execute(
+                'SELECT MIN(next_eligible) FROM queuefiles WHERE blacklisted == 0 AND next_eligible > ?',
+                [time.time()]
+            )
+            return cur.fetchone()[0]
+
+    def get_statistics(self):
+        '''
+        Return a list of dicts with the number of attempts, successes, and
+        failures, the average duration, and successes per hour of running time
+        for each extension.
+        '''
+        with self.lock:
+            cur = self.sql.execute(
+                '''
+                SELECT extension, COUNT(*), SUM(exit_code == 0), SUM(duration)
+                FROM attempts GROUP BY extension ORDER BY extension
+                '''
+            )
+            rows = cur.fetchall()
+
+        statistics = []
+        for (extension, attempts, successes, duration) in rows:
+            statistics.append(dotdict.DotDict(
+                extension=extension,
+                attempts=attempts,
+                successes=successes,
+                failures=attempts - successes,
+                average_duration=duration / attempts,
+                per_hour=(successes / duration * 3600) if duration else 0,
+            ))
+        return statistics
+
+    def is_eligible(self, file):
+        with self.lock:
+            cur = self.sql.execute(
+                'SELECT blacklisted, next_eligible FROM queuefiles WHERE path == ?',
+                [file.absolute_path]
+            )
+            row = cur.fetchone()
+        if row is None:
+            return True
+        (blacklisted, next_eligible) = row
+        return (not blacklisted) and time.time() >= next_eligible
+
+    def prune(self):
+        '''
+        Forget the time outs and blacklistings of files that no longer exist.
+        '''
+        with self.lock:
+            paths = [row[0] for row in self.sql.execute('SELECT path FROM queuefiles')]
+            gone = [[path] for path in paths if not os.path.exists(path)]
+            if gone:
+                self.sql.executemany('DELETE FROM queuefiles WHERE path == ?', gone)
+                self.sql.commit()
+
+    def set_timeout(self, file, failures, next_eligible):
+        with self.lock:
+            self.sql.execute(
+                '''
+                INSERT INTO queuefiles VALUES(?, ?, ?, ?, 0, NULL)
+                ON CONFLICT(path) DO UPDATE SET
+                failures = excluded.failures, next_eligible = excluded.next_eligible
+                ''',
+                [file.absolute_path, file.extension.no_dot.lower(), failures, next_eligible]
+            )
+            self.sql.commit()
+
+journal = Journal()
+
+class Claims:
+    '''
+    Lets any number of q processes, on one machine or on several machines
+    sharing a mount, pull from the same folders without processing the same
+    file twice.
+
+    Before processing a queuefile, we create a claim file for it in the
+    folder's CLAIMS_DIRECTORY. The claim is created with O_EXCL, which is
+    atomic, so only one process can succeed. The claim is a lease: while we
+    are processing the file we touch the claim every so often, and a claim
+    that hasn't been touched for longer than the lease is presumed to belong
+    to a dead process and can be taken over.
+    '''
+    def __init__(self, lease=300):
+        self.lease = lease
+        self.owner = f'{socket.gethostname()} {os.getpid()} {uuid.uuid4().hex}'
+        # claim paths
+        self.held = set()
+        self.lock = threading.Lock()
+        self.renewer = None
+
+    def _break_stale(self, path):
+        '''
+        Remove the claim if it is stale, and return True if it is now gone.
+        '''
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return True
+
+        if time.time() - mtime < self.lease:
+            return False
+
+        # Renaming is atomic, so if several processes find the same stale
+        # claim only one of them gets to remove it.
+        tombstone = f'{path}.{uuid.uuid4().hex}.stale'
+        try:
+            os.rename(path, tombstone)
+        except FileNotFoundError:
+            return True
+
+        if time.time() - os.stat(tombstone).st_mtime < self.lease:
+            # Somebody else took over the stale claim in between our stat and
+            # our rename, so this is their fresh claim. Put it back. Unlike
+            # rename, link won't overwrite a claim that a third process has
+            # created in the meantime. If there is one, it holds the file now.
+            try:
+                os.link(tombstone, path)
+            except FileExistsError:
+                pass
+            os.remove(tombstone)
+            return False
+
+        os.remove(tombstone)
+        log.info('Took over the stale claim %s.', path)
+        return True
+
+    def _claim_path(self, file):
+        return os.path.join(file.parent.absolute_path, CLAIMS_DIRECTORY, file.basename)
+
+    def _renew_forever(self):
+        while True:
+            time.sleep(self.lease / 3)
+            with self.lock:
+                held = list(self.held)
+            for path in held:
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    log.warning('Our claim %s has disappeared.', path)
+
+    def claim(self, file):
+        '''
+        Return True if we have claimed the file, or False if another process
+        holds a live claim on it.
+        '''
+        path = self._claim_path(file)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        try:
+            handle = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not self._break_stale(path):
+                return False
+            try:
+                handle = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                return False
+
+        with os.fdopen(handle, 'w') as handle:
+            handle.write(self.owner)
+
+        with self.lock:
+            self.held.add(path)
+            if self.renewer is None:
+                self.renewer = threading.Thread(target=self._renew_forever, daemon=True)
+                self.renewer.start()
+        return True
+
+    def is_claimed(self, file):
+        '''
+        Return True if another process holds a live claim on the file.
+        '''
+        path = self._claim_path(file)
+        with self.lock:
+            if path in self.held:
+                return False
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return False
+        return time.time() - mtime < self.lease
+
+    def release(self, file):
+        path = self._claim_path(file)
+        with self.lock:
+            self.held.discard(path)
 
-# When no more queuefiles are discovered, the program will sleep for increasing
-# amounts of time to reduce the amount of disk activity.
-sleeping_backoff = backoff.Linear(m=1, b=10, max=600)
+        try:
+            with open(path, 'r') as handle:
+                owner = handle.read()
+        except FileNotFoundError:
+            return
+
+        # If we were stalled for longer than the lease, someone else may have
+        # taken over the claim, and it's theirs to remove.
+        if owner != self.owner:
+            log.warning('Our claim %s was taken over by %s.', path, owner)
+            return
+
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+# When --workers is more than 1, each queuefile is processed on its own thread.
+# These are the files currently being processed, so that the next scan does not
+# start them a second time.
+running_files = {}
+running_lock = threading.Lock()
+
+# Worker threads set this when they finish, so that we can rescan and fill the
+# free slot right away instead of waiting for the folders to change.
+worker_finished = threading.Event()
+
+class FolderWatcher:
+    '''
+    Waits for queuefiles to appear in the folders, so that we only need to
+    list the folders when something has changed.
+
+    This class works by polling. Creating, deleting, or renaming a file changes
+    the mtime of its folder, so an idle folder costs one stat per interval
+    instead of a full listdir.
+    '''
+    interval = 1
 
-# Each file gets an individual backoff object when it encounters an error, so
-# we can continue processing other files while and come back to the problematic
-# ones later, with increasing timeouts.
-error_backoffs = {}
+    def __init__(self, folders):
+        self.folders = folders
+        self.mtimes = self._get_mtimes()
+
+    def _get_mtimes(self):
+        mtimes = {}
+        for folder in self.folders:
+            try:
+                mtimes[folder] = os.stat(folder).st_mtime_ns
+            except OSError:
+                mtimes[folder] = None
+        return mtimes
+
+    def _wait_for_change(self, timeout):
+        time.sleep(timeout)
+        mtimes = self._get_mtimes()
+        if mtimes == self.mtimes:
+            return False
+        self.mtimes = mtimes
+        return True
+
+    def wait(self, timeout):
+        '''
+        Sleep until one of the folders changes, a worker finishes, or the
+        timeout runs out, whichever comes first.
+        '''
+        deadline = time.monotonic() + timeout
+        while True:
+            if worker_finished.is_set():
+                worker_finished.clear()
+                return
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+
+            if self._wait_for_change(min(self.interval, remaining)):
+                return
+
+class InotifyFolderWatcher(FolderWatcher):
+    '''
+    Same as FolderWatcher, except the folders are watched with inotify instead
+    of polled, so new queuefiles are noticed as soon as they are written.
+
+    Requires the inotify_simple package, and Linux.
+    '''
+    def __init__(self, folders):
+        super().__init__(folders)
+        self.inotify = inotify_simple.INotify()
+        mask = (
+            inotify_simple.flags.CREATE |
+            inotify_simple.flags.MOVED_TO |
+            inotify_simple.flags.CLOSE_WRITE
+        )
+        for folder in folders:
+            self.inotify.add_watch(folder.absolute_path, mask)
+
+    def _wait_for_change(self, timeout):
+        # The read_delay lets a file's CREATE and CLOSE_WRITE arrive together
+        # so they cost one scan instead of two.
+        events = self.inotify.read(timeout=int(timeout * 1000), read_delay=50)
+        return bool(events)
+
+def get_folder_watcher(folders):
+    if inotify_simple is not None:
+        try:
+            return InotifyFolderWatcher(folders)
+        except OSError:
+            log.debug('Could not use inotify, falling back to polling.')
+    return FolderWatcher(folders)
 
-# If a file demonstrates unrecoverable errors, we blacklist it and never touch
-# it again. If the file ever disappears then we remove it from the blacklist.
-error_blacklist = set()
+def dispatch_file(file, workers, limits, claims=None, link_workers=1):
+    '''
+    Start processing this file on a worker thread, unless it is already
+    running, or all of the workers are busy, or its extension has reached its
+    concurrency limit.
+    '''
+    if not is_eligible(file, claims=claims):
+        return False
+
+    extension = file.extension.no_dot.lower()
+    limit = limits.get(extension)
+
+    with running_lock:
+        if file in running_files:
+            return False
+
+        if len(running_files) >= workers:
+            return False
+
+        if limit is not None:
+            running = sum(1 for f in running_files if f.extension.no_dot.lower() == extension)
+            if running >= limit:
+                return False
+
+        thread = threading.Thread(target=_process_file_thread, args=[file, claims, link_workers], daemon=True)
+        running_files[file] = thread
+
+    thread.start()
+    return True
+
+def _process_file_thread(file, claims, link_workers):
+    try:
+        process_file(file, capture_output=True, claims=claims, link_workers=link_workers)
+    except Exception:
+        log.error('%s raised:\n%s', file.absolute_path, traceback.format_exc())
+    finally:
+        with running_lock:
+            running_files.pop(file, None)
+        worker_finished.set()
 
 def filter_collaborate(files, collaborate):
     if collaborate is None:
@@ -66,20 +498,18 @@ def handle_blacklist(file, reason=''):
     else:
         log.warning('%s is blacklisted.', file.absolute_path)
 
-    error_blacklist.add(file)
+    journal.blacklist(file, reason=reason)
 
 def handle_failure(file):
-    err_bo = error_backoffs.get(file)
-    if err_bo is None:
-        err_bo = backoff.Linear(m=3600, b=3600, max=86400)
-        error_backoffs[file] = err_bo
+    err_bo = backoff.Linear(m=3600, b=3600, max=86400)
+    err_bo.x = journal.get_failures(file)
 
     if (err_bo.x % 3) == 1:
         log.warning('%s is having repeated problems.', file.absolute_path)
 
     timeout = err_bo.next()
     log.info('%s is in time out for %d.', file.absolute_path, timeout)
-    err_bo.expire_at = time.time() + timeout
+    journal.set_timeout(file, failures=err_bo.x, next_eligible=time.time() + timeout)
 
 def override_extension_commands(extension, command):
     extension = extension.lower().strip('.')
@@ -94,6 +524,24 @@ def override_extension_commands(extension, command):
     qcommands.EXTENSION_COMMANDS.clear()
     qcommands.EXTENSION_COMMANDS[extension] = (command, '{id}')
 
+def is_eligible(file, claims=None):
+    # Race condition
+    if not file.exists:
+        return False
+
+    if not journal.is_eligible(file):
+        return False
+
+    if claims is not None and claims.is_claimed(file):
+        return False
+
+    extension = file.extension.no_dot.lower()
+
+    if not get_extension_command(extension):
+        return False
+
+    return True
+
 def parse_collaborate(collaborate):
     if collaborate is None:
         return None
@@ -113,77 +561,151 @@ def parse_collaborate(collaborate):
     collaborate = dotdict.DotDict(mod=mod, mine=mine)
     return collaborate
 
-def process_file(file, args=None):
-    # Race condition
-    if not file.exists:
-        return
+def parse_limits(limits):
+    if not limits:
+        return {}
 
-    if file in error_blacklist:
-        return
+    result = {}
+    for limit in limits:
+        (extension, count) = limit.split('=')
+        extension = extension.lower().strip('.')
+        count = int(count)
+        if count < 1:
+            raise ValueError(f'Limit for {extension} must be at least 1, not {count}.')
+        result[extension] = count
+    return result
 
-    err_bo = error_backoffs.get(file)
-    if err_bo is not None and time.time() < err_bo.expire_at:
+def process_file(file, args=None, capture_output=False, claims=None, link_workers=1):
+    if not is_eligible(file, claims=claims):
         return
 
-    extension = file.extension.no_dot.lower()
-
-    if not get_extension_command(extension):
+    if claims is None:
+        _process_file(file, capture_output=capture_output, link_workers=link_workers)
         return
 
-    ############################################################################
+    if not claims.claim(file):
+        return
 
-    sleeping_backoff.reset()
+    try:
+        # Another process may have finished the file in between our listdir
+        # and our claim.
+        if file.exists:
+            _process_file(file, capture_output=capture_output, link_workers=link_workers)
+    finally:
+        claims.release(file)
 
-    commands = []
+def _process_file(file, capture_output=False, link_workers=1):
+    extension = file.extension.no_dot.lower()
+    (command, argument) = get_extension_command(extension)
+    started = time.time()
 
     if file.size > 0:
-        links = read_file_links(file)
-        (command, argument) = get_extension_command(extension)
-        commands.extend(f'{command} "{link}"' for link in links)
+        exit_code = process_links(
+            file,
+            command,
+            # Concurrent links would garble each other's console output.
+            capture_output=capture_output or link_workers > 1,
+            link_workers=link_workers,
+        )
 
     else:
-        (command, argument) = get_extension_command(extension)
         base = file.replace_extension('').basename
         argument = argument.format(id=base)
-        commands.append(f'{command} {argument}')
-
-    exit_code = 0
-
-    for command in commands:
+        command = f'{command} {argument}'
         log.info(f'Handling {file.basename} with `{command}`')
+        exit_code = run_command(command, capture_output=capture_output, prefix=file.basename)
 
-        exit_code = os.system(command)
-        if exit_code != 0:
-            handle_failure(file)
-            break
+    journal.add_attempt(file, started=started, duration=time.time() - started, exit_code=exit_code)
 
-    if exit_code == 0:
-        try:
-            os.remove(file)
-        except FileNotFoundError:
-            # Race condition
-            pass
-        except PermissionError:
-            handle_blacklist(file, reason=traceback.format_exc())
+    if exit_code != 0:
+        handle_failure(file)
+        return
 
-def prune_blacklist():
-    if not error_blacklist:
+    try:
+        os.remove(file)
+    except FileNotFoundError:
+        # Race condition
+        pass
+    except PermissionError:
+        handle_blacklist(file, reason=traceback.format_exc())
         return
 
-    for file in list(error_blacklist):
-        if not file.exists:
-            error_blacklist.remove(file)
+    journal.clear(file)
+
+def get_rescan_timeout():
+    '''
+    Return the number of seconds until the next file comes out of time out,
+    or RESCAN_INTERVAL if that is sooner.
+    '''
+    next_eligible = journal.get_next_eligible()
+    if next_eligible is None:
+        return RESCAN_INTERVAL
+    return min(next_eligible - time.time(), RESCAN_INTERVAL)
 
-def prune_error_backoffs():
-    if not error_backoffs:
+def print_statistics():
+    statistics = journal.get_statistics()
+    if not statistics:
+        print('The journal has no attempts yet.')
         return
 
-    now = time.time()
+    width = max(len('extension'), *(len(s.extension) for s in statistics))
+    print(f'{"extension":<{width}}  attempts  succeeded  failed  avg seconds  per hour')
+    for s in statistics:
+        print(
+            f'{s.extension:<{width}}  {s.attempts:>8}  {s.successes:>9}  {s.failures:>6}  '
+            f'{s.average_duration:>11.1f}  {s.per_hour:>8.1f}'
+        )
 
-    for (file, err_bo) in list(error_backoffs.items()):
-        if not file.exists:
-            error_backoffs.pop(file)
-            continue
+def process_links(file, command, capture_output=False, link_workers=1):
+    '''
+    Run the command once for each link in the queuefile, up to link_workers
+    at a time. Each link is removed from the file as soon as it succeeds, so
+    if another link fails, the retry only repeats the links that haven't
+    succeeded yet. After the first failure, no new links are started.
+
+    Return the exit code of the first failed link, or 0 if they all succeeded.
+    '''
+    links = list(read_file_links(file))
+    if not links:
+        return 0
+
+    failed = threading.Event()
+    file_lock = threading.Lock()
+
+    def process_link(link):
+        if failed.is_set():
+            return None
+
+        link_command = f'{command} "{link}"'
+        log.info(f'Handling {file.basename} with `{link_command}`')
+        exit_code = run_command(link_command, capture_output=capture_output, prefix=file.basename)
+        if exit_code != 0:
+            failed.set()
+            return exit_code
+
+        with file_lock:
+            remove_file_link(file, link)
+        return exit_code
+
+    if link_workers > 1:
+        pool = threadpool.ThreadPool(link_workers, paused=True)
+        pool.add_many({'function': process_link, 'args': [link]} for link in links)
+        try:
+            jobs = list(pool.result_generator())
+        finally:
+            # The result_generator leaves the pool paused, and the threads
+            # need to be running to notice that it has closed.
+            pool.close()
+            pool.start()
+        for job in jobs:
+            if job.exception:
+                raise job.exception
+        exit_codes = [job.value for job in jobs]
+    else:
+        exit_codes = [process_link(link) for link in links]
+
+    failures = [exit_code for exit_code in exit_codes if exit_code]
+    return failures[0] if failures else 0
 
 def read_file_links(file):
     links = file.open('r').read().splitlines()
@@ -192,7 +714,62 @@ def read_file_links(file):
     links = (l for l in links if not l.startswith('#'))
     return links
 
-def queue_once(folders, collaborate=None):
+def remove_file_link(file, link):
+    '''
+    Rewrite the queuefile without this link. The file is replaced atomically
+    so a crash can't lose the other links.
+
+    The last link is left in place, because an emptied queuefile would be
+    mistaken for one whose name is the argument. The file is deleted once
+    all of its links succeed anyway.
+    '''
+    lines = file.open('r').read().splitlines()
+    for (index, line) in enumerate(lines):
+        if line.strip() == link:
+            lines.pop(index)
+            break
+    else:
+        # The file was edited while the link was running.
+        return
+
+    remaining = (line.strip() for line in lines)
+    if not any(line and not line.startswith('#') for line in remaining):
+        return
+
+    temp = file.absolute_path + '.tmp'
+    with open(temp, 'w') as handle:
+        handle.write('\n'.join(lines) + '\n')
+    os.replace(temp, file.absolute_path)
+
+def run_command(command, capture_output=False, prefix=''):
+    '''
+    Run the command and return its exit code. With capture_output, the
+    command's output is logged line by line with the given prefix instead of
+    going straight to the console, so that the output of concurrent jobs can be
+    told apart.
+    '''
+    if not capture_output:
+        status = os.system(command)
+        if os.name == 'posix':
+            status = os.waitstatus_to_exitcode(status)
+        return status
+
+    process = subprocess.Popen(
+        command,
+        shell=True,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors='replace',
+    )
+    for line in process.stdout:
+        line = line.rstrip()
+        if line:
+            log.info('%s: %s', prefix, line)
+    return process.wait()
+
+def queue_once(folders, collaborate=None, workers=1, limits=None, claims=None, link_workers=1):
     log.info(time.strftime('%H:%M:%S Looking for files.'))
     files = []
     for folder in folders:
@@ -204,15 +781,39 @@ def queue_once(folders, collaborate=None):
     files = filter_collaborate(files, collaborate)
 
     for file in files:
-        process_file(file)
+        if workers > 1:
+            dispatch_file(
+                file,
+                workers=workers,
+                limits=limits or {},
+                claims=claims,
+                link_workers=link_workers,
+            )
+        else:
+            process_file(file, claims=claims, link_workers=link_workers)
 
-    prune_error_backoffs()
-    prune_blacklist()
+    journal.prune()
 
-def queue_forever(folders, collaborate=None):
+def queue_forever(folders, collaborate=None, workers=1, limits=None, claims=None, link_workers=1):
+    watcher = get_folder_watcher(folders)
     while True:
-        queue_once(folders, collaborate=collaborate)
-        time.sleep(sleeping_backoff.next())
+        queue_once(
+            folders,
+            collaborate=collaborate,
+            workers=workers,
+            limits=limits,
+            claims=claims,
+            link_workers=link_workers,
+        )
+        watcher.wait(timeout=get_rescan_timeout())
+
+def wait_for_worker(timeout=None):
+    '''
+    Sleep until a worker thread finishes or the timeout runs out, whichever
+    comes first.
+    '''
+    worker_finished.wait(timeout)
+    worker_finished.clear()
 
 def q_argparse(args):
     if args.extension:
@@ -226,12 +827,38 @@ def q_argparse(args):
     for folder in folders:
         folder.assert_is_directory()
 
+    if args.journal:
+        journal.open_database(args.journal)
+
+    if args.stats:
+        print_statistics()
+        return 0
+
+    limits = dict(getattr(qcommands, 'EXTENSION_LIMITS', {}))
+    limits.update(parse_limits(args.limits))
+
+    claims = Claims(lease=args.lease) if args.claim else None
+
+    kwargs = dict(
+        folders=folders,
+        collaborate=args.collaborate,
+        workers=args.workers,
+        limits=limits,
+        claims=claims,
+        link_workers=args.link_workers,
+    )
+
     if args.once:
-        queue_once(folders=folders)
+        queue_once(**kwargs)
+        # Keep rescanning as workers finish, to pick up the files that were
+        # waiting for a free slot.
+        while running_files:
+            wait_for_worker()
+            queue_once(**kwargs)
         return 0
 
     try:
-        queue_forever(folders=folders, collaborate=args.collaborate)
+        queue_forever(**kwargs)
     except KeyboardInterrupt:
         return 0
 
@@ -303,6 +930,90 @@ def main(argv):
         If you want to collaborate with three processes, you'd use
         --collaborate 3.1 for one instance, --collaborate 3.2 for the second, and
         --collaborate 3.3 for the third.
+        See also --claim, which balances the load between the processes as
+        they go instead of partitioning the files ahead of time.
+        ''',
+    )
+    parser.add_argument(
+        '--claim',
+        dest='claim',
+        action='store_true',
+        help='''
+        Claim each queuefile before processing it, so that any number of q
+        processes, on this machine or others sharing the folder over the
+        network, can work on the same folders without doing the same file
+        twice. Whichever process is free picks up the next file. The claims
+        are kept in a .qclaims directory inside each folder.
+        ''',
+    )
+    parser.add_argument(
+        '--lease',
+        dest='lease',
+        type=float,
+        default=300,
+        metavar='seconds',
+        help='''
+        With --claim, a process renews its claims while it's working on them.
+        If a process dies, its claims can be taken over by the others after
+        this many seconds without renewal.
+        ''',
+    )
+    parser.add_argument(
+        '--workers',
+        dest='workers',
+        type=int,
+        default=1,
+        help='''
+        Process up to this many queuefiles at the same time. Each command's
+        output is captured and logged with the name of its queuefile, so the
+        concurrent jobs don't garble each other. The default of 1 processes
+        files one at a time with the command's output going straight to the
+        console.
+        ''',
+    )
+    parser.add_argument(
+        '--limits',
+        dest='limits',
+        nargs='+',
+        default=[],
+        metavar='extension=N',
+        help='''
+        With --workers, don't run more than N queuefiles of this extension at
+        the same time, for example --limits youtube=3 wayback=10. These
+        override any EXTENSION_LIMITS in qcommands.
+        ''',
+    )
+    parser.add_argument(
+        '--link_workers',
+        dest='link_workers',
+        type=int,
+        default=1,
+        help='''
+        Within a non-empty queuefile, run up to this many links at the same
+        time. Either way, each link is removed from the queuefile as soon as it
+        succeeds, so a file that fails partway through only retries the links
+        that are left.
+        ''',
+    )
+    parser.add_argument(
+        '--journal',
+        dest='journal',
+        default=None,
+        metavar='filepath',
+        help='''
+        Keep the record of attempts, time outs, and blacklisted files in this
+        sqlite database, so they are remembered across restarts. Without this,
+        the record is kept in memory only, and every file that was in time out
+        will be tried again as soon as the program restarts.
+        ''',
+    )
+    parser.add_argument(
+        '--stats',
+        dest='stats',
+        action='store_true',
+        help='''
+        Print the number of attempts, successes, failures, average duration,
+        and successes per hour for each extension in the --journal, then quit.
         ''',
     )
     parser.set_defaults(func=q_argparse)
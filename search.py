@@ -1,28 +1,46 @@
 import argparse
+import codecs
+import collections
+import datetime
+import fnmatch
 import itertools
+import json
+import locale
+import mmap
 import os
+import queue
 import re
+import sqlite3
 import stat
 import sys
+import threading
+import time
 import traceback
 try:
     import winshell
 except ImportError:
     winshell = None
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
 try:
     import pysrt
 except ImportError:
     pysrt = None
 
+from voussoirkit import bytestring
 from voussoirkit import expressionmatch
 from voussoirkit import pathclass
 from voussoirkit import pipeable
 from voussoirkit import safeprint
 from voussoirkit import spinal
+from voussoirkit import threadpool
 from voussoirkit import vlogging
 from voussoirkit import winglob
 
 log = vlogging.get_logger(__name__, 'search')
+vlogging.get_logger('threadpool').setLevel(vlogging.WARNING)
 
 # Thanks georg
 # http://stackoverflow.com/a/13443424
@@ -32,6 +50,8 @@ if stat.S_ISFIFO(STDIN_MODE):
 else:
     STDIN_MODE = 'terminal'
 
+IGNORE_FILENAMES = ['.gitignore', '.ignore']
+
 class NoTerms(Exception):
     pass
 
@@ -44,6 +64,706 @@ class HeaderedText:
     def with_header(self):
         return f'{self.header}: {self.text}'
 
+class IgnoreFile:
+    '''
+    The patterns of one .gitignore or .ignore file, which apply to the items
+    underneath the directory that contains it.
+
+    This supports the commonly used parts of the gitignore format: comments,
+    negation with !, directory-only patterns ending in /, patterns anchored to
+    the directory by a leading or inner /, and the *, ?, [], and ** wildcards.
+    '''
+    def __init__(self, directory, lines):
+        self.directory = directory
+        self.rules = []
+        for line in lines:
+            rule = self._parse_line(line)
+            if rule is not None:
+                self.rules.append(rule)
+
+    @classmethod
+    def from_directory(cls, directory):
+        lines = []
+        for name in IGNORE_FILENAMES:
+            try:
+                with open(os.path.join(directory.absolute_path, name), 'r', encoding='utf-8') as handle:
+                    lines.extend(handle.read().splitlines())
+            except (OSError, UnicodeDecodeError):
+                continue
+        if not lines:
+            return None
+        return cls(directory, lines)
+
+    @staticmethod
+    def _glob_to_regex(pattern):
+        regex = []
+        index = 0
+        while index < len(pattern):
+            char = pattern[index]
+            if pattern.startswith('**/', index):
+                regex.append('(?:.*/)?')
+                index += 3
+                continue
+            if pattern.startswith('/**', index) and index + 3 == len(pattern):
+                regex.append('/.*')
+                index += 3
+                continue
+            if pattern.startswith('**', index):
+                regex.append('.*')
+                index += 2
+                continue
+            if char == '*':
+                regex.append('[^/]*')
+            elif char == '?':
+                regex.append('[^/]')
+            elif char == '[':
+                close = pattern.find(']', index + 2)
+                if close == -1:
+                    regex.append(re.escape(char))
+                else:
+                    charclass = pattern[index+1:close].replace('\\', '\\\\')
+                    if charclass.startswith('!'):
+                        charclass = '^' + charclass[1:]
+                    regex.append(f'[{charclass}]')
+                    index = close
+            elif char == '\\' and index + 1 < len(pattern):
+                index += 1
+                regex.append(re.escape(pattern[index]))
+            else:
+                regex.append(re.escape(char))
+            index += 1
+        return re.compile(''.join(regex) + r'\Z')
+
+    def _parse_line(self, line):
+        line = line.rstrip()
+        if not line or line.startswith('#'):
+            return None
+
+        negate = line.startswith('!')
+        if negate:
+            line = line[1:]
+        elif line.startswith('\\'):
+            line = line[1:]
+
+        dir_only = line.endswith('/')
+        line = line.rstrip('/')
+        if not line:
+            return None
+
+        # A pattern with a slash anywhere but the end is relative to this
+        # directory. Otherwise it matches the basename at any depth.
+        anchored = '/' in line
+        line = line.lstrip('/')
+
+        regex = self._glob_to_regex(line)
+        return (regex, negate, dir_only, anchored)
+
+    def match(self, path, is_dir):
+        '''
+        Return True if the path is ignored by this file, False if it is
+        explicitly un-ignored by a ! pattern, or None if no patterns apply.
+        '''
+        relative = path.absolute_path[len(self.directory.absolute_path):].lstrip(os.sep)
+        relative = relative.replace(os.sep, '/')
+        basename = relative.rsplit('/', 1)[-1]
+
+        # Later patterns take precedence over earlier ones.
+        for (regex, negate, dir_only, anchored) in reversed(self.rules):
+            if dir_only and not is_dir:
+                continue
+            if regex.match(relative if anchored else basename):
+                return not negate
+        return None
+
+class SearchResult:
+    '''
+    One result from search_results.
+
+    path:
+        For name searches, the absolute path of the item that matched. For
+        content searches, the absolute path of the file containing the line.
+        None when searching plain text.
+
+    line_number:
+        The 1-indexed line number of a text or content result, else None.
+
+    offset:
+        The byte offset at which the line starts in its file, if known.
+
+    spans:
+        A list of (start, end) character ranges within `text` where the search
+        terms matched. Context lines have no spans.
+
+    text:
+        The text that was searched: the basename for name searches, or the
+        line for text and content searches.
+
+    is_context:
+        True if this line did not match, and is only here because it is near
+        one that did.
+    '''
+    def __init__(
+            self,
+            text,
+            *,
+            display=None,
+            is_context=False,
+            line_number=None,
+            offset=None,
+            path=None,
+            spans=None,
+        ):
+        self.text = text
+        self.display = text if display is None else display
+        self.is_context = is_context
+        self.line_number = line_number
+        self.offset = offset
+        self.path = path
+        self.spans = spans or []
+
+    def __repr__(self):
+        return f'SearchResult(path={self.path!r}, line_number={self.line_number!r}, text={self.text!r})'
+
+    def __str__(self):
+        return self.display
+
+    def jsonify(self):
+        return {
+            'path': self.path,
+            'line_number': self.line_number,
+            'offset': self.offset,
+            'spans': [list(span) for span in self.spans],
+            'text': self.text,
+            'is_context': self.is_context,
+        }
+
+SUBTITLE_DB_INIT = '''
+BEGIN;
+CREATE TABLE IF NOT EXISTS subtitle_text(
+    path TEXT PRIMARY KEY NOT NULL,
+    size INT NOT NULL,
+    mtime_ns INT NOT NULL,
+    text TEXT NOT NULL
+);
+COMMIT;
+'''
+
+class SubtitleCache:
+    '''
+    Keeps the normalized text of .srt files so that repeat searches don't
+    have to parse them again. Entries are keyed by path and only used if the
+    file's size and mtime haven't changed since.
+
+    The cache is kept in memory, which helps --watch and repeated calls in
+    the same process, and in sqlite if open_database has been called, which
+    helps across runs. A one-shot search reads each file once anyway, so the
+    memory layer is bounded by the total length of the texts rather than the
+    number of files, and the least recently used texts are dropped first.
+
+    The database file is not created until a subtitle file is searched, so
+    that name searches with --index don't leave one behind.
+    '''
+    def __init__(self, max_chars=2**24):
+        self.max_chars = max_chars
+        self.memory = collections.OrderedDict()
+        self.memory_chars = 0
+        self.filepath = None
+        self.sql = None
+        # With --jobs, several threads can be searching srt files at once.
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.sql is not None or self.filepath is None:
+            return
+        self.sql = sqlite3.connect(self.filepath.absolute_path, check_same_thread=False)
+        # It's only a cache. If it gets lost, we just parse the files again.
+        self.sql.execute('PRAGMA synchronous = OFF')
+        self.sql.executescript(SUBTITLE_DB_INIT)
+
+    def _remember(self, path, size, mtime_ns, text):
+        old = self.memory.pop(path, None)
+        if old is not None:
+            self.memory_chars -= len(old[2])
+
+        if len(text) > self.max_chars:
+            return
+
+        self.memory[path] = (size, mtime_ns, text)
+        self.memory_chars += len(text)
+        while self.memory_chars > self.max_chars:
+            (_, (_, _, dropped)) = self.memory.popitem(last=False)
+            self.memory_chars -= len(dropped)
+
+    def open_database(self, filepath):
+        self.filepath = pathclass.Path(filepath)
+        self.sql = None
+
+    def get(self, filepath, size, mtime_ns):
+        with self.lock:
+            cached = self.memory.get(filepath.absolute_path)
+            if cached is not None and cached[:2] == (size, mtime_ns):
+                self.memory.move_to_end(filepath.absolute_path)
+                return cached[2]
+
+            self._connect()
+            if self.sql is None:
+                return None
+
+            cur = self.sql.execute(
+                'SELECT text FROM subtitle_text WHERE path == ? AND size == ? AND mtime_ns == ?',
+                [filepath.absolute_path, size, mtime_ns]
+            )
+            row = cur.fetchone()
+            if row is None:
+                return None
+
+            self._remember(filepath.absolute_path, size, mtime_ns, row[0])
+            return row[0]
+
+    def set(self, filepath, size, mtime_ns, text):
+        with self.lock:
+            self._remember(filepath.absolute_path, size, mtime_ns, text)
+
+            self._connect()
+            if self.sql is None:
+                return
+
+            self.sql.execute(
+                'INSERT OR REPLACE INTO subtitle_text(path, size, mtime_ns, text) VALUES(?, ?, ?, ?)',
+                [filepath.absolute_path, size, mtime_ns, text]
+            )
+            self.sql.commit()
+
+SRT_CACHE = SubtitleCache()
+
+class TextLine:
+    '''
+    One line of a file being content-searched, along with its 1-indexed line
+    number and the byte offset at which the line starts. Files are not always
+    read from top to bottom, so the number can't be assumed from the order
+    the lines are searched.
+    '''
+    def __init__(self, number, offset, text):
+        self.number = number
+        self.offset = offset
+        self.text = text
+
+INDEX_DB_INIT = '''
+BEGIN;
+CREATE TABLE IF NOT EXISTS directories(
+    path TEXT PRIMARY KEY NOT NULL,
+    mtime_ns INT
+);
+CREATE TABLE IF NOT EXISTS entries(
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    parent TEXT NOT NULL,
+    basename TEXT NOT NULL,
+    basename_lower TEXT NOT NULL,
+    is_dir INT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS index_entries_parent on entries(parent);
+COMMIT;
+'''
+
+# The trigram table lets plain terms of 3+ characters be answered without
+# scanning every basename. It needs SQLite 3.34 or newer, so the index still
+# works without it, just slower.
+INDEX_DB_TRIGRAM = '''
+BEGIN;
+CREATE VIRTUAL TABLE IF NOT EXISTS entries_trigram USING fts5(
+    basename,
+    content='entries',
+    content_rowid='id',
+    tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS entries_trigram_insert AFTER INSERT ON entries BEGIN
+    INSERT INTO entries_trigram(rowid, basename) VALUES (new.id, new.basename);
+END;
+CREATE TRIGGER IF NOT EXISTS entries_trigram_delete AFTER DELETE ON entries BEGIN
+    INSERT INTO entries_trigram(entries_trigram, rowid, basename) VALUES ('delete', old.id, old.basename);
+END;
+COMMIT;
+'''
+
+class FilenameIndex:
+    '''
+    A sqlite database of the file and directory names underneath one or more
+    root directories, so that name searches don't have to walk the disk.
+
+    The index is refreshed incrementally. Adding, removing, or renaming an
+    item changes the mtime of its parent directory, so only directories whose
+    mtime has changed since the last refresh need to be listed again. The
+    rest cost one stat each.
+    '''
+    def __init__(self, filepath):
+        self.filepath = pathclass.Path(filepath)
+        # With --jobs, the query generator is consumed by the pool's threads.
+        # The pool only lets one thread pull from it at a time.
+        self.sql = sqlite3.connect(self.filepath.absolute_path, check_same_thread=False)
+        self.sql.executescript(INDEX_DB_INIT)
+        try:
+            self.sql.executescript(INDEX_DB_TRIGRAM)
+            self.has_trigram = True
+        except sqlite3.OperationalError:
+            log.debug('This version of sqlite does not support trigram tokenizer.')
+            self.sql.rollback()
+            self.has_trigram = False
+
+    @staticmethod
+    def _subtree_range(path):
+        # All paths underneath this directory sort between these two strings,
+        # which lets the queries use the primary key / parent indices instead
+        # of scanning the table with LIKE.
+        prefix = path.rstrip(os.sep) + os.sep
+        return (prefix, prefix[:-1] + chr(ord(os.sep) + 1))
+
+    def _delete_subtree(self, cur, path):
+        (low, high) = self._subtree_range(path)
+        cur.execute('DELETE FROM directories WHERE path == ? OR (path >= ? AND path < ?)', [path, low, high])
+        cur.execute('DELETE FROM entries WHERE path == ? OR (path >= ? AND path < ?)', [path, low, high])
+
+    def _rescan_directory(self, cur, directory):
+        try:
+            entries = list(os.scandir(directory))
+        except (OSError, PermissionError):
+            log.debug('Could not scan %s.', directory)
+            entries = []
+
+        rows = cur.execute('SELECT path, is_dir FROM entries WHERE parent == ?', [directory])
+        old = {path: is_dir for (path, is_dir) in rows}
+        new = {entry.path: int(entry.is_dir()) for entry in entries}
+
+        for (path, is_dir) in old.items():
+            if path in new and new[path] == is_dir:
+                continue
+            if is_dir:
+                self._delete_subtree(cur, path)
+            else:
+                cur.execute('DELETE FROM entries WHERE path == ?', [path])
+
+        for entry in entries:
+            if entry.path in old and old[entry.path] == new[entry.path]:
+                continue
+            cur.execute(
+                'INSERT INTO entries(path, parent, basename, basename_lower, is_dir) VALUES(?, ?, ?, ?, ?)',
+                [entry.path, directory, entry.name, entry.name.lower(), new[entry.path]]
+            )
+
+        return [entry.path for entry in entries if new[entry.path]]
+
+    def refresh(self, root_path):
+        '''
+        Bring the index for this root directory up to date with the disk.
+        '''
+        root = pathclass.Path(root_path).absolute_path
+        log.debug('Refreshing index of %s.', root)
+        cur = self.sql.cursor()
+
+        (low, high) = self._subtree_range(root)
+        rows = cur.execute(
+            'SELECT path, mtime_ns FROM directories WHERE path == ? OR (path >= ? AND path < ?)',
+            [root, low, high]
+        )
+        known_mtimes = dict(rows)
+
+        pending = [root]
+        while pending:
+            directory = pending.pop()
+            try:
+                mtime_ns = os.stat(directory).st_mtime_ns
+            except (OSError, PermissionError):
+                self._delete_subtree(cur, directory)
+                continue
+
+            if known_mtimes.get(directory) == mtime_ns:
+                rows = cur.execute('SELECT path FROM entries WHERE parent == ? AND is_dir == 1', [directory])
+                pending.extend(path for (path,) in rows)
+                continue
+
+            log.debug('Rescanning %s.', directory)
+            pending.extend(self._rescan_directory(cur, directory))
+            cur.execute('INSERT OR REPLACE INTO directories(path, mtime_ns) VALUES(?, ?)', [directory, mtime_ns])
+
+        self.sql.commit()
+
+    def is_indexed(self, root_path):
+        root = pathclass.Path(root_path).absolute_path
+        cur = self.sql.cursor()
+        cur.execute('SELECT 1 FROM directories WHERE path == ?', [root])
+        return cur.fetchone() is not None
+
+    def query(
+            self,
+            root_path,
+            *,
+            yes_all=None,
+            yes_any=None,
+            case_sensitive=False,
+            exclude=None,
+            local_only=False,
+            only_dirs=False,
+            only_files=False,
+            use_ignore_files=False,
+        ):
+        '''
+        Yield pathclass.Path objects for the indexed items underneath this
+        root directory.
+
+        yes_all, yes_any:
+            Plain substring terms used to narrow down the rows inside sqlite.
+            This is only a prefilter. The caller is still responsible for
+            matching the full set of terms against the results.
+
+        exclude, use_ignore_files:
+            Same as walk. The index contains everything, so the excluded
+            items are filtered out of the results instead.
+        '''
+        root = pathclass.Path(root_path).absolute_path
+        wheres = []
+        bindings = []
+
+        if local_only:
+            wheres.append('parent == ?')
+            bindings.append(root)
+        else:
+            (low, high) = self._subtree_range(root)
+            wheres.append('(parent == ? OR (parent >= ? AND parent < ?))')
+            bindings.extend([root, low, high])
+
+        if only_dirs:
+            wheres.append('is_dir == 1')
+        if only_files:
+            wheres.append('is_dir == 0')
+
+        column = 'basename' if case_sensitive else 'basename_lower'
+
+        def term_where(term):
+            if not case_sensitive:
+                term = term.lower()
+            if self.has_trigram and len(term) >= 3:
+                term = term.replace('"', '""')
+                return ('id IN (SELECT rowid FROM entries_trigram WHERE entries_trigram MATCH ?)', f'"{term}"')
+            return (f'instr({column}, ?)', term)
+
+        for term in yes_all or []:
+            (where, binding) = term_where(term)
+            wheres.append(where)
+            bindings.append(binding)
+
+        if yes_any:
+            any_wheres = [term_where(term) for term in yes_any]
+            wheres.append('(' + ' OR '.join(where for (where, binding) in any_wheres) + ')')
+            bindings.extend(binding for (where, binding) in any_wheres)
+
+        query = 'SELECT path, is_dir FROM entries WHERE ' + ' AND '.join(wheres) + ' ORDER BY path'
+        log.loud(query)
+        is_excluded = _make_exclude_checker(root, exclude, use_ignore_files)
+        cur = self.sql.cursor()
+        for (path, is_dir) in cur.execute(query, bindings):
+            path = pathclass.Path(path)
+            if is_excluded is not None and is_excluded(path, is_dir):
+                continue
+            yield path
+
+class DirectoryWatcher:
+    '''
+    Keeps track of the items underneath a root directory so that it can report
+    which ones have been created since the last check, and which files have
+    been modified if track_files is True.
+
+    This class works by polling. Adding, removing, or renaming an item changes
+    the mtime of its parent directory, so only the directories whose mtime
+    has changed need to be listed again. The rest cost one stat each. When
+    track_files is True, each file costs one stat as well.
+    '''
+    def __init__(
+            self,
+            root_path,
+            *,
+            exclude=None,
+            recurse=True,
+            track_files=False,
+            use_ignore_files=False,
+        ):
+        self.exclude = _prepare_exclude(exclude, use_ignore_files)
+        self.recurse = recurse
+        self.track_files = track_files
+        self.use_ignore_files = use_ignore_files
+
+        # abspath: (mtime_ns, {child abspath: is_dir}, inherited ignore files)
+        self.directories = {}
+        # abspath: (size, mtime_ns)
+        self.files = {}
+
+        root = pathclass.Path(root_path)
+        root.assert_is_directory()
+        self._scan(root, inherited_ignore_files=(), report=False)
+
+    def _forget(self, path):
+        directory = self.directories.pop(path, None)
+        if directory is not None:
+            for child in directory[1]:
+                self._forget(child)
+        self.files.pop(path, None)
+
+    def _on_directory(self, directory):
+        pass
+
+    def _file_signature(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime_ns)
+
+    def _scan(self, directory, inherited_ignore_files, report=True):
+        '''
+        List the directory, update our records of it, and return the children
+        which were not previously known. New subdirectories are scanned too.
+        '''
+        self._on_directory(directory)
+
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except OSError:
+            self._forget(directory.absolute_path)
+            return []
+
+        (children, ignore_files) = _list_directory(
+            directory,
+            self.exclude,
+            inherited_ignore_files,
+            self.use_ignore_files,
+        )
+        known = self.directories.get(directory.absolute_path)
+        known = known[1] if known else {}
+        current = {child.absolute_path: is_dir for (child, is_dir, entry) in children}
+
+        for (path, is_dir) in known.items():
+            if current.get(path) != is_dir:
+                self._forget(path)
+
+        self.directories[directory.absolute_path] = (mtime_ns, current, inherited_ignore_files)
+
+        created = []
+        for (child, is_dir, entry) in children:
+            if known.get(child.absolute_path) == is_dir:
+                continue
+
+            if report:
+                created.append(child)
+
+            if is_dir and self.recurse:
+                created.extend(self._scan(child, ignore_files, report=report))
+            elif not is_dir and self.track_files:
+                self.files[child.absolute_path] = self._file_signature(child.absolute_path)
+
+        return created
+
+    def poll(self):
+        '''
+        Return a list of pathclass.Path for the items that have been created,
+        or modified if track_files, since the last poll.
+        '''
+        changed = []
+        for (path, (mtime_ns, children, inherited_ignore_files)) in list(self.directories.items()):
+            # It may have been forgotten during this loop.
+            if path not in self.directories:
+                continue
+
+            try:
+                current_mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:
+                self._forget(path)
+                continue
+
+            if current_mtime_ns != mtime_ns:
+                changed.extend(self._scan(pathclass.Path(path), inherited_ignore_files))
+
+        if self.track_files:
+            for (path, signature) in list(self.files.items()):
+                current_signature = self._file_signature(path)
+                if current_signature is not None and current_signature != signature:
+                    self.files[path] = current_signature
+                    changed.append(pathclass.Path(path))
+
+        return changed
+
+    def wait(self, interval):
+        time.sleep(interval)
+        return self.poll()
+
+class InotifyWatcher(DirectoryWatcher):
+    '''
+    Same as DirectoryWatcher, except the directories are watched with inotify
+    instead of polled, so we only do any work for the directories that
+    actually changed, and changes are noticed as soon as they happen instead
+    of at the next interval.
+
+    Requires the inotify_simple package, and Linux.
+    '''
+    def __init__(self, *args, **kwargs):
+        self.inotify = inotify_simple.INotify()
+        # wd: directory abspath
+        self.watches = {}
+        super().__init__(*args, **kwargs)
+
+    def _on_directory(self, directory):
+        # The watch is added before the directory is listed so that nothing
+        # can be created in between without us hearing about it.
+        mask = (
+            inotify_simple.flags.CREATE |
+            inotify_simple.flags.DELETE |
+            inotify_simple.flags.MOVED_FROM |
+            inotify_simple.flags.MOVED_TO |
+            inotify_simple.flags.CLOSE_WRITE
+        )
+        try:
+            wd = self.inotify.add_watch(directory.absolute_path, mask)
+        except OSError:
+            log.debug('Could not watch %s.', directory.absolute_path)
+            return
+        self.watches[wd] = directory.absolute_path
+
+    def wait(self, interval):
+        flags = inotify_simple.flags
+        events = self.inotify.read(timeout=int(interval * 1000))
+
+        dirty = set()
+        modified = set()
+        for event in events:
+            if event.mask & flags.Q_OVERFLOW:
+                log.warning('The inotify queue overflowed, falling back to a full poll.')
+                return self.poll()
+
+            directory = self.watches.get(event.wd)
+            if directory is None:
+                continue
+
+            if event.mask & flags.IGNORED:
+                self.watches.pop(event.wd)
+            elif event.mask & (flags.CREATE | flags.DELETE | flags.MOVED_FROM | flags.MOVED_TO):
+                dirty.add(directory)
+            elif event.mask & flags.CLOSE_WRITE and self.track_files:
+                modified.add(os.path.join(directory, event.name))
+
+        changed = []
+        for directory in dirty:
+            known = self.directories.get(directory)
+            if known is not None:
+                changed.extend(self._scan(pathclass.Path(directory), known[2]))
+
+        changed_paths = {path.absolute_path for path in changed}
+        for path in modified:
+            if path not in self.files:
+                continue
+            self.files[path] = self._file_signature(path)
+            if path not in changed_paths:
+                changed.append(pathclass.Path(path))
+
+        return changed
+
 def all_terms_match(search_text, terms, match_function):
     matches = (
         (not terms['yes_all'] or all(match_function(search_text, term) for term in terms['yes_all'])) and
@@ -53,6 +773,190 @@ def all_terms_match(search_text, terms, match_function):
     )
     return matches
 
+def _call_matcher(text, matcher):
+    return matcher(text)
+
+def _plain_matcher(term):
+    def matcher(text):
+        return term in text
+    return matcher
+
+def compile_terms(
+        terms,
+        *,
+        case_sensitive=False,
+        do_expression=False,
+        do_glob=False,
+        do_regex=False,
+    ):
+    '''
+    Convert the dict of yes_all, yes_any, not_all, not_any term lists into
+    lists of functions which take a line of text and return whether the term
+    matches it. Regexes and globs are compiled here once instead of for every
+    line, and the plain terms of yes_any and not_any are combined into a
+    single regex so each line is scanned once regardless of the term count.
+
+    If not case_sensitive, the caller is responsible for lowercasing the text
+    before passing it to the functions, so that it only happens once per line
+    instead of once per term.
+    '''
+    if do_expression:
+        # The value still needs to be a list so the upcoming any() / all()
+        # receives an iterable as it expects. It just happens to be 1 tree.
+        trees = {}
+        for (term_type, term_expression) in terms.items():
+            if term_expression == []:
+                trees[term_type] = []
+                continue
+            tree = ' '.join(term_expression)
+            tree = expressionmatch.ExpressionTree.parse(tree)
+            if not case_sensitive:
+                tree.map(str.lower)
+            trees[term_type] = [tree.evaluate]
+        return trees
+
+    if not case_sensitive:
+        terms = {k: [x.lower() for x in v] for (k, v) in terms.items()}
+
+    do_plain = not (do_glob or do_regex)
+    matchers = {}
+    for (term_type, term_list) in terms.items():
+        matchers[term_type] = []
+
+        for term in term_list:
+            term_matchers = []
+            if do_regex:
+                term_matchers.append(re.compile(term).search)
+            if do_glob:
+                pattern = os.path.normcase(winglob.fix(term))
+                pattern = re.compile(fnmatch.translate(pattern))
+                if os.name == 'nt':
+                    # Same as fnmatch.fnmatch, which normcases both sides.
+                    term_matchers.append(lambda text, pattern=pattern: pattern.match(os.path.normcase(text)))
+                else:
+                    term_matchers.append(pattern.match)
+
+            if len(term_matchers) == 1:
+                matchers[term_type].append(term_matchers[0])
+            elif term_matchers:
+                # With both --regex and --glob, a term matches if either
+                # interpretation of it does, so it's still one matcher for the
+                # purposes of the all / any lists.
+                matchers[term_type].append(
+                    lambda text, term_matchers=term_matchers: any(matcher(text) for matcher in term_matchers)
+                )
+
+        if not do_plain or not term_list:
+            continue
+
+        # For the "any" lists, one alternation regex answers the same
+        # question as checking each term in turn. The "all" lists have to
+        # check each term individually anyway, and `in` is fast for that.
+        if term_type in {'yes_any', 'not_any'} and len(term_list) > 1:
+            pattern = '|'.join(re.escape(term) for term in term_list)
+            matchers[term_type].append(re.compile(pattern).search)
+        else:
+            matchers[term_type].extend(_plain_matcher(term) for term in term_list)
+
+    return matchers
+
+def compile_metadata_filter(
+        *,
+        extensions=None,
+        larger_than=None,
+        newer_than=None,
+        older_than=None,
+        smaller_than=None,
+    ):
+    '''
+    Return a function which is called as filter_function(basename, is_dir,
+    stat) and returns True if the item passes all of the given predicates, or
+    None if no predicates were given. `stat` is a function that returns the
+    item's stat result, so it is only called if a size or time predicate
+    needs it. When walking, that's the DirEntry's stat method, which is
+    cached, and free on Windows where scandir already has the data.
+
+    The extension and size predicates only pass files, not directories.
+
+    extensions:
+        A list of extensions, with or without the dot, case insensitive.
+
+    larger_than, smaller_than:
+        Sizes in bytes.
+
+    newer_than, older_than:
+        Unix timestamps compared against the mtime.
+    '''
+    if extensions:
+        extensions = {extension.lower().lstrip('.') for extension in extensions}
+
+    files_only = bool(extensions) or larger_than is not None or smaller_than is not None
+    need_stat = not (larger_than is None and smaller_than is None and newer_than is None and older_than is None)
+
+    if not (files_only or need_stat):
+        return None
+
+    def filter_function(basename, is_dir, stat):
+        if files_only and is_dir:
+            return False
+
+        if extensions and os.path.splitext(basename)[1].lower().lstrip('.') not in extensions:
+            return False
+
+        if not need_stat:
+            return True
+
+        try:
+            st = stat()
+        except OSError:
+            return False
+
+        return (
+            (larger_than is None or st.st_size > larger_than) and
+            (smaller_than is None or st.st_size < smaller_than) and
+            (newer_than is None or st.st_mtime > newer_than) and
+            (older_than is None or st.st_mtime < older_than)
+        )
+
+    return filter_function
+
+def compile_spans(
+        terms,
+        *,
+        case_sensitive=False,
+        do_expression=False,
+        do_glob=False,
+        do_regex=False,
+    ):
+    '''
+    Return a function which takes a line of text that is already known to
+    match, and returns the sorted (start, end) ranges where the yes_all and
+    yes_any terms occur in it. Like compile_terms, the text must already be
+    lowercased if not case_sensitive.
+
+    Globs and expressions describe the line as a whole, so their span is the
+    whole line.
+    '''
+    positive = terms['yes_all'] + terms['yes_any']
+    if not positive or do_expression or do_glob:
+        return lambda text: [(0, len(text))] if positive else []
+
+    if not case_sensitive:
+        positive = [term.lower() for term in positive]
+
+    if do_regex:
+        patterns = [re.compile(term) for term in positive]
+    else:
+        patterns = [re.compile('|'.join(re.escape(term) for term in positive if term))]
+
+    def find_spans(text):
+        spans = set()
+        for pattern in patterns:
+            spans.update(match.span() for match in pattern.finditer(text) if match.end() > match.start())
+        return sorted(spans)
+
+    return find_spans
+
 def is_iterable(something):
     try:
         iter(something)
@@ -60,39 +964,189 @@ def is_iterable(something):
     except TypeError:
         return False
 
-def search_contents_generic(filepath, content_args):
-    # We first test 1 MB of the file to see if it is text rather than binary.
+def _content_needle(content_args, encoding):
+    '''
+    Return a compiled bytes regex which every matching line must contain, or
+    None if the content terms can't be reduced to one. Searching the raw bytes
+    for the needle lets us skip over the non-matching lines without decoding
+    them at all.
+    '''
+    if content_args.get('do_expression') or content_args.get('do_glob') or content_args.get('do_regex'):
+        return None
+
+    case_sensitive = content_args.get('case_sensitive')
+    yes_all = content_args.get('yes_all') or []
+    yes_any = content_args.get('yes_any') or []
+    yes_all = [yes_all] if isinstance(yes_all, str) else yes_all
+    yes_any = [yes_any] if isinstance(yes_any, str) else yes_any
+
+    # Every line must contain all of yes_all, so the longest one is the most
+    # selective needle. Otherwise the line must contain one of yes_any.
+    if yes_all:
+        needles = [max(yes_all, key=len)]
+    elif yes_any:
+        needles = yes_any
+    else:
+        return None
+
+    # The bytes regex can only fold the case of ascii letters.
+    if not case_sensitive and not all(needle.isascii() for needle in needles):
+        return None
+
     try:
-        handle = filepath.open('r')
-        handle.read(2 ** 20)
-    except UnicodeDecodeError:
+        needles = [re.escape(needle.encode(encoding)) for needle in needles]
+    except UnicodeEncodeError:
+        return None
+
+    if b'\n' in b''.join(needles):
+        return None
+
+    flags = 0 if case_sensitive else re.IGNORECASE
+    return re.compile(b'|'.join(needles), flags)
+
+def _count_newlines(mm, start, end, chunk_size=2 ** 24):
+    # Slicing a mmap makes a copy, so we do it in chunks to avoid pulling a
+    # huge stretch of the file into memory at once.
+    count = 0
+    while start < end:
+        stop = min(start + chunk_size, end)
+        count += mm[start:stop].count(b'\n')
+        start = stop
+    return count
+
+def _mmap_line(mm, number, start, encoding):
+    end = mm.find(b'\n', start)
+    if end == -1:
+        end = len(mm)
+    text = mm[start:end].rstrip(b'\r\n').decode(encoding, errors='replace')
+    return (TextLine(number, start, text), end + 1)
+
+def _mmap_all_lines(mm, encoding):
+    offset = 0
+    number = 0
+    while offset < len(mm):
+        number += 1
+        (line, offset) = _mmap_line(mm, number, offset, encoding)
+        yield line
+
+def _mmap_needle_lines(mm, encoding, needle, before=0, after=0):
+    # Only the lines containing the needle are decoded and yielded, plus the
+    # requested number of lines around them so that context can be shown.
+    # The line numbers are found by counting the newlines we skipped over.
+    # Everything before `offset` has already been yielded or skipped, and
+    # `number` is the line number of the line that ended there.
+    offset = 0
+    number = 0
+    while True:
+        match = needle.search(mm, offset)
+        if not match:
+            return
+        start = mm.rfind(b'\n', offset, match.start())
+        start = offset if start == -1 else start + 1
+        match_number = number + 1 + _count_newlines(mm, offset, start)
+
+        context_starts = []
+        context_start = start
+        while len(context_starts) < before and context_start > offset:
+            context_start = mm.rfind(b'\n', offset, context_start - 1)
+            context_start = offset if context_start == -1 else context_start + 1
+            context_starts.append(context_start)
+
+        number = match_number - len(context_starts)
+        for context_start in reversed(context_starts):
+            (line, offset) = _mmap_line(mm, number, context_start, encoding)
+            yield line
+            number += 1
+
+        (line, offset) = _mmap_line(mm, number, start, encoding)
+        yield line
+
+        # If one of the trailing lines is also a match, then it needs its own
+        # trailing lines too.
+        remaining = after
+        while remaining > 0 and offset < len(mm):
+            number += 1
+            line_start = offset
+            (line, offset) = _mmap_line(mm, number, offset, encoding)
+            yield line
+            if needle.search(mm, line_start, offset - 1):
+                remaining = after
+            else:
+                remaining -= 1
+
+def _sniff_encoding(head):
+    # We test 1 MB of the file to see if it is text rather than binary.
+    for encoding in [locale.getpreferredencoding(False), 'utf-8']:
+        decoder = codecs.getincrementaldecoder(encoding)()
         try:
-            handle.close()
-            handle = filepath.open('r', encoding='utf-8')
-            handle.read(2 ** 20)
+            decoder.decode(head, final=False)
         except UnicodeDecodeError:
-            log.debug('%s could not be read with encoding=utf-8.', filepath)
-            return
+            continue
+        return encoding
+    return None
+
+def parse_time(text):
+    '''
+    Convert either an age like "90s", "30m", "12h", "2d", "1w" into the unix
+    timestamp that long ago, or an ISO date like "2021-06-01" into its unix
+    timestamp.
+    '''
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([smhdw])', text.strip().lower())
+    if match:
+        (number, unit) = match.groups()
+        return time.time() - (float(number) * units[unit])
+    return datetime.datetime.fromisoformat(text.strip()).timestamp()
+
+def search_contents_generic(filepath, content_args):
+    try:
+        handle = filepath.open('rb')
     except Exception:
         safeprint.safeprint(filepath.absolute_path)
         traceback.print_exc()
         return
 
-    # We keep the lines as a generator instead of using readlines,
-    # which makes a list.
-    handle.seek(0)
-    lines = (line.rstrip('\r\n') for line in handle)
-    content_args['text'] = lines
-    content_args['line_numbers'] = True
+    with handle:
+        if filepath.size == 0:
+            return
 
-    results = search(**content_args)
-    results = list(results)
-    if not results:
-        return
+        try:
+            mm = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            safeprint.safeprint(filepath.absolute_path)
+            traceback.print_exc()
+            return
+
+        with mm:
+            encoding = _sniff_encoding(mm[:2 ** 20])
+            if encoding is None:
+                log.debug('%s could not be read with encoding=utf-8.', filepath)
+                return
+
+            needle = _content_needle(content_args, encoding)
+            if needle is None:
+                lines = _mmap_all_lines(mm, encoding)
+            else:
+                lines = _mmap_needle_lines(
+                    mm,
+                    encoding,
+                    needle,
+                    before=content_args.get('context_before') or 0,
+                    after=content_args.get('context_after') or 0,
+                )
+
+            content_args['text'] = lines
+            content_args['line_numbers'] = True
 
-    yield filepath.absolute_path
-    yield from results
-    yield ''
+            results = search_results(**content_args)
+            yield from _file_results(filepath, results)
+
+def _file_results(filepath, results):
+    # The results of searching the file's text don't know where the text came
+    # from, so here we fill that in.
+    for result in results:
+        result.path = filepath.absolute_path
+        yield result
 
 def _srt_format_line(line):
     text = line.text.replace('\n', ' ')
@@ -101,21 +1155,25 @@ def _srt_format_line(line):
 
 def search_contents_srt(filepath, content_args):
     try:
-        srtlines = pysrt.open(filepath.absolute_path)
-    except UnicodeDecodeError:
-        log.warn('%s experienced Unicode Error', filepath.absolute_path)
+        stat = filepath.stat
+    except OSError:
         return
 
-    content_args['text'] = '\n'.join(_srt_format_line(line) for line in srtlines)
+    text = SRT_CACHE.get(filepath, stat.st_size, stat.st_mtime_ns)
+    if text is None:
+        try:
+            srtlines = pysrt.open(filepath.absolute_path)
+        except UnicodeDecodeError:
+            log.warn('%s experienced Unicode Error', filepath.absolute_path)
+            return
+
+        text = '\n'.join(_srt_format_line(line) for line in srtlines)
+        SRT_CACHE.set(filepath, stat.st_size, stat.st_mtime_ns, text)
 
-    results = search(**content_args)
-    results = list(results)
-    if not results:
-        return
+    content_args['text'] = text
 
-    yield filepath.absolute_path
-    yield from results
-    yield ''
+    results = search_results(**content_args)
+    yield from _file_results(filepath, results)
 
 def search_contents_windows_lnk(filepath, content_args):
     try:
@@ -131,16 +1189,118 @@ def search_contents_windows_lnk(filepath, content_args):
     ]
     content_args['text'] = text
 
-    results = search(**content_args)
-    results = list(results)
-    if not results:
+    results = search_results(**content_args)
+    yield from _file_results(filepath, results)
+
+def search_contents(filepath, content_args):
+    # Each file gets its own copy of the content_args because the handlers
+    # below insert the file's text into it, and with --jobs several files are
+    # being handled at the same time.
+    content_args = content_args.copy()
+
+    if filepath.extension == 'lnk' and winshell:
+        return search_contents_windows_lnk(filepath, content_args)
+    elif filepath.extension == 'srt' and pysrt:
+        return search_contents_srt(filepath, content_args)
+    else:
+        return search_contents_generic(filepath, content_args)
+
+def _search_contents_list(filepath, content_args):
+    return list(search_contents(filepath, content_args))
+
+def search_contents_parallel(filepaths, content_args, jobs, ordered=True):
+    '''
+    Search the contents of the given files using a pool of `jobs` threads.
+    The results of each file are collected by the thread that searched it, so
+    they are always yielded together as a group.
+
+    ordered:
+        If True, the groups are yielded in the same order as the filepaths,
+        so the output looks the same as a single-threaded search.
+        If False, the groups are yielded as soon as each file is finished.
+    '''
+    pool = threadpool.ThreadPool(jobs, paused=True)
+    # The filepaths are usually coming from a lazy walk, so the buffers are
+    # used to keep the pool from running too far ahead of the consumer.
+    buffer_size = jobs * 4
+
+    def handle_job(job):
+        if job.exception:
+            log.error(''.join(traceback.format_exception(None, job.exception, job.exception.__traceback__)))
+            return []
+        return job.value
+
+    # If the consumer stops early, this stops the generators from giving the
+    # pool any more files. The finally blocks below then let the jobs that
+    # were already started run out, so that no thread is left blocked on a
+    # full buffer, and close the pool so its threads exit.
+    stop = threading.Event()
+
+    def take_filepaths():
+        for filepath in filepaths:
+            if stop.is_set():
+                break
+            yield filepath
+
+    if ordered:
+        pool.add_generator(
+            {'function': _search_contents_list, 'args': [filepath, content_args]}
+            for filepath in take_filepaths()
+        )
+        results = pool.result_generator(buffer_size=buffer_size)
+        try:
+            for job in results:
+                yield from handle_job(job)
+        finally:
+            stop.set()
+            for job in results:
+                pass
+            # The result_generator leaves the pool paused, and the threads
+            # need to be running to notice that it has closed.
+            pool.close()
+            pool.start()
         return
 
-    yield filepath.absolute_path
-    yield from results
-    yield ''
+    # The callback of each job puts it into this queue as soon as it is done.
+    # When the filepaths are exhausted, the generator puts the total number of
+    # jobs so we know how many to wait for.
+    finished_jobs = queue.Queue(maxsize=buffer_size)
+
+    def job_generator():
+        count = 0
+        for filepath in take_filepaths():
+            yield {
+                'function': _search_contents_list,
+                'args': [filepath, content_args],
+                'callback': finished_jobs.put,
+            }
+            count += 1
+        finished_jobs.put(count)
+
+    pool.add_generator(job_generator())
+    pool.start()
 
-def search(
+    total = None
+    received = 0
+    try:
+        while total is None or received < total:
+            job = finished_jobs.get()
+            if isinstance(job, int):
+                total = job
+                continue
+            received += 1
+            yield from handle_job(job)
+    finally:
+        stop.set()
+        while total is None or received < total:
+            job = finished_jobs.get()
+            if isinstance(job, int):
+                total = job
+            else:
+                received += 1
+        pool.close()
+
+def search_results(
         *,
         yes_all=None,
         yes_any=None,
@@ -148,17 +1308,35 @@ def search(
         not_any=None,
         case_sensitive=False,
         content_args=None,
+        context_after=0,
+        context_before=0,
         do_expression=False,
         do_glob=False,
         do_regex=False,
         do_strip=False,
+        exclude=None,
+        index=None,
+        index_refresh=False,
+        extensions=None,
+        jobs=1,
+        larger_than=None,
         line_numbers=False,
         local_only=False,
+        max_results=None,
+        newer_than=None,
+        older_than=None,
         only_dirs=False,
         only_files=False,
+        ordered=True,
         root_path='.',
+        smaller_than=None,
         text=None,
+        use_ignore_files=False,
     ):
+    '''
+    Yield SearchResult objects for the items, lines, or file contents that
+    match the terms. See `search` for the same results formatted as text.
+    '''
     terms = {
         'yes_all': yes_all,
         'yes_any': yes_any,
@@ -168,43 +1346,68 @@ def search(
     terms = {k: ([v] if isinstance(v, str) else v or []) for (k, v) in terms.items()}
     #print(terms, content_args)
 
-    do_plain = not (do_glob or do_regex)
+    metadata_filter = compile_metadata_filter(
+        extensions=extensions,
+        larger_than=larger_than,
+        newer_than=newer_than,
+        older_than=older_than,
+        smaller_than=smaller_than,
+    )
 
-    if all(v == [] for v in terms.values()) and not content_args:
+    if all(v == [] for v in terms.values()) and not content_args and metadata_filter is None:
         raise NoTerms('No terms supplied')
 
-    def term_matches(line, term):
-        if not case_sensitive:
-            line = line.lower()
-
-        if do_expression:
-            return term.evaluate(line)
+    matchers = compile_terms(
+        terms,
+        case_sensitive=case_sensitive,
+        do_expression=do_expression,
+        do_glob=do_glob,
+        do_regex=do_regex,
+    )
+    find_spans = compile_spans(
+        terms,
+        case_sensitive=case_sensitive,
+        do_expression=do_expression,
+        do_glob=do_glob,
+        do_regex=do_regex,
+    )
 
-        return (
-            (do_plain and term in line) or
-            (do_regex and re.search(term, line)) or
-            (do_glob and winglob.fnmatch(line, term))
+    if text is None and index is not None:
+        if not isinstance(index, FilenameIndex):
+            index = FilenameIndex(index)
+        if index_refresh or not index.is_indexed(root_path):
+            index.refresh(root_path)
+        prefilter = not (do_expression or do_glob or do_regex)
+        search_objects = index.query(
+            root_path,
+            yes_all=terms['yes_all'] if prefilter else None,
+            yes_any=terms['yes_any'] if prefilter else None,
+            case_sensitive=case_sensitive,
+            exclude=exclude,
+            local_only=local_only,
+            only_dirs=only_dirs,
+            only_files=only_files,
+            use_ignore_files=use_ignore_files,
         )
-
-    if do_expression:
-        # The value still needs to be a list so the upcoming any() / all()
-        # receives an iterable as it expects. It just happens to be 1 tree.
-        trees = {}
-        for (term_type, term_expression) in terms.items():
-            if term_expression == []:
-                trees[term_type] = []
-                continue
-            tree = ' '.join(term_expression)
-            tree = expressionmatch.ExpressionTree.parse(tree)
-            if not case_sensitive:
-                tree.map(str.lower)
-            trees[term_type] = [tree]
-        terms = trees
-
-    elif not case_sensitive:
-        terms = {k: [x.lower() for x in v] for (k, v) in terms.items()}
-
-    if text is None:
+        # The index has already applied these without touching the disk, so
+        # we don't need to stat every result again below.
+        only_dirs = False
+        only_files = False
+    elif text is None and (exclude or use_ignore_files or only_dirs or only_files or metadata_filter):
+        search_objects = walk(
+            root_path,
+            exclude=exclude,
+            filter_function=metadata_filter,
+            recurse=not local_only,
+            use_ignore_files=use_ignore_files,
+            yield_directories=not only_files,
+            yield_files=not only_dirs,
+        )
+        # The walk has already applied these using its DirEntry objects.
+        only_dirs = False
+        only_files = False
+        metadata_filter = None
+    elif text is None:
         search_objects = spinal.walk(
             root_path,
             callback_permission_denied=spinal.do_nothing,
@@ -218,46 +1421,370 @@ def search(
     else:
         raise TypeError(f'Don\'t know how to search text={text}')
 
-    for (index, search_object) in enumerate(search_objects):
-        # if index % 10 == 0:
-        #     print(index, end='\r', flush=True)
+    if metadata_filter is not None:
+        # These paths didn't come from our walk, so each one costs a stat.
+        def stat_filter(search_object):
+            if not isinstance(search_object, pathclass.Path):
+                return True
+            try:
+                st = os.stat(search_object)
+            except OSError:
+                return False
+            return metadata_filter(search_object.basename, stat.S_ISDIR(st.st_mode), lambda: st)
+        search_objects = (search_object for search_object in search_objects if stat_filter(search_object))
+
+    def make_result(search_object, number, spans=None):
+        is_context = spans is None
+        path = None
+        line_number = number
+        offset = None
+
         if isinstance(search_object, pathclass.Path):
-            if only_files and not search_object.is_file:
-                continue
-            if only_dirs and not search_object.is_dir:
-                continue
-            search_text = search_object.basename
-            result_text = search_object.absolute_path
+            path = search_object.absolute_path
+            line_number = None
+            text = search_object.basename
+            display = search_object.absolute_path
         elif isinstance(search_object, HeaderedText):
-            search_text = search_object.text
-            result_text = search_object.with_header
+            text = search_object.text
+            display = search_object.with_header
+        elif isinstance(search_object, TextLine):
+            offset = search_object.offset
+            text = search_object.text
+            display = search_object.text
         else:
-            search_text = search_object
-            result_text = search_object
-
-        if not all_terms_match(search_text, terms, term_matches):
-            continue
+            text = search_object
+            display = search_object
 
         if do_strip:
-            result_text = result_text.strip()
+            display = display.strip()
 
         if line_numbers:
-            result_text = f'{index+1:>4} | {result_text}'
+            separator = '-' if is_context else '|'
+            display = f'{number:>4} {separator} {display}'
+
+        return SearchResult(
+            text,
+            display=display,
+            is_context=is_context,
+            line_number=line_number,
+            offset=offset,
+            path=path,
+            spans=spans,
+        )
+
+    def matching_objects():
+        # Context lines are only meaningful when searching lines of text.
+        do_context = (context_before or context_after) and not content_args
+        before_lines = collections.deque(maxlen=context_before)
+        after_remaining = 0
+        last_number = None
+        match_count = 0
+
+        for (index, search_object) in enumerate(search_objects):
+            # if index % 10 == 0:
+            #     print(index, end='\r', flush=True)
+            if isinstance(search_object, pathclass.Path):
+                if only_files and not search_object.is_file:
+                    continue
+                if only_dirs and not search_object.is_dir:
+                    continue
+                search_text = search_object.basename
+            elif isinstance(search_object, (HeaderedText, TextLine)):
+                search_text = search_object.text
+            else:
+                search_text = search_object
+
+            if isinstance(search_object, TextLine):
+                index = search_object.number - 1
+            number = index + 1
+
+            if max_results is not None and match_count >= max_results:
+                # We've stopped looking for matches, but we still owe the
+                # trailing context of the last one.
+                is_match = False
+            else:
+                if not case_sensitive:
+                    search_text = search_text.lower()
+                is_match = all_terms_match(search_text, matchers, _call_matcher)
+
+            if not is_match:
+                if do_context and after_remaining > 0 and number == last_number + 1:
+                    yield (search_object, make_result(search_object, number))
+                    last_number = number
+                    after_remaining -= 1
+                elif do_context:
+                    after_remaining = 0
+                    before_lines.append((number, search_object))
+
+                if max_results is not None and match_count >= max_results and after_remaining == 0:
+                    return
+                continue
+
+            if do_context:
+                for (context_number, context_object) in before_lines:
+                    if context_number >= number - context_before:
+                        yield (context_object, make_result(context_object, context_number))
+                before_lines.clear()
+                after_remaining = context_after
+                last_number = number
+
+            yield (search_object, make_result(search_object, number, spans=find_spans(search_text)))
+            match_count += 1
+
+            if max_results is not None and match_count >= max_results and not after_remaining:
+                return
+
+    if not content_args:
+        for (search_object, result) in matching_objects():
+            yield result
+        return
+
+    filepaths = (pathclass.Path(search_object) for (search_object, result) in matching_objects())
+    filepaths = (filepath for filepath in filepaths if filepath.is_file)
+
+    if jobs > 1:
+        yield from search_contents_parallel(filepaths, content_args, jobs=jobs, ordered=ordered)
+        return
+
+    for filepath in filepaths:
+        yield from search_contents(filepath, content_args)
+
+def format_results(results, *, content_args=None, context_after=0, context_before=0, **kwargs):
+    '''
+    Yield the SearchResults as lines of text. Content results are grouped
+    under a header line with the file's path and followed by a blank line,
+    and non-adjacent groups of context lines are separated by `--`.
+
+    The kwargs should be the same ones given to search_results.
+    '''
+    if content_args:
+        do_context = content_args.get('context_before') or content_args.get('context_after')
+    else:
+        do_context = context_before or context_after
+
+    current_path = None
+    last_number = None
+    for result in results:
+        if content_args and result.path != current_path:
+            if current_path is not None:
+                yield ''
+            yield result.path
+            current_path = result.path
+            last_number = None
+
+        if do_context and last_number is not None and result.line_number > last_number + 1:
+            yield '--'
+        last_number = result.line_number
+
+        yield str(result)
 
-        if not content_args:
-            yield result_text
+    if current_path is not None:
+        yield ''
+
+def search(**kwargs):
+    '''
+    Yield the results of search_results as lines of text.
+    '''
+    yield from format_results(search_results(**kwargs), **kwargs)
+
+def search_watch(*, interval=5, **kwargs):
+    '''
+    Yield the results of search_results, then keep watching the root
+    directory and yield the results of searching each item that gets created
+    from then on, or modified in the case of content searches. This generator
+    never ends.
+
+    The directories are watched with inotify if the inotify_simple package is
+    available, otherwise they are polled every `interval` seconds.
+    '''
+    if kwargs.get('text') is not None:
+        raise ValueError('Watching only works when searching a directory, not text.')
+
+    watcher_class = InotifyWatcher if inotify_simple else DirectoryWatcher
+    watcher = watcher_class(
+        kwargs.get('root_path', '.'),
+        exclude=kwargs.get('exclude'),
+        recurse=not kwargs.get('local_only'),
+        track_files=bool(kwargs.get('content_args')),
+        use_ignore_files=kwargs.get('use_ignore_files'),
+    )
+
+    yield from search_results(**kwargs)
+
+    # From now on we're searching the changed items directly, so the index
+    # doesn't need to be consulted.
+    kwargs['index'] = None
+    while True:
+        changed = watcher.wait(interval)
+        if not changed:
+            continue
+        log.debug('%d items changed.', len(changed))
+        kwargs['text'] = changed
+        yield from search_results(**kwargs)
+
+def _prepare_exclude(exclude, use_ignore_files):
+    exclude = [os.path.normcase(pattern) for pattern in (exclude or [])]
+    if use_ignore_files:
+        exclude.append('.git')
+    return exclude
+
+def _is_excluded(path, is_dir, exclude, ignore_files):
+    n_basename = os.path.normcase(path.basename)
+    n_abspath = os.path.normcase(path.absolute_path)
+    for pattern in exclude:
+        if n_basename == pattern or n_abspath == pattern or winglob.fnmatch(n_basename, pattern):
+            return True
+
+    # The deepest ignore file has the final say.
+    for ignore_file in reversed(ignore_files):
+        status = ignore_file.match(path, is_dir)
+        if status is not None:
+            return status
+    return False
+
+def _make_exclude_checker(root, exclude, use_ignore_files):
+    '''
+    Return a function which is called as is_excluded(path, is_dir) and
+    returns True if walk would have skipped that item underneath the root,
+    either because it or one of its parent directories is excluded. Returns
+    None if there is nothing to exclude.
+
+    This is for paths that didn't come from walk, like the results of the
+    index. The ignore files and the verdicts on directories are remembered,
+    so each directory is only checked once.
+    '''
+    exclude = _prepare_exclude(exclude, use_ignore_files)
+    if not exclude and not use_ignore_files:
+        return None
+
+    root = pathclass.Path(root)
+    # The IgnoreFiles that apply to the children of each directory.
+    ignore_files_cache = {root: ()}
+    excluded_directories = {root: False}
+
+    def ignore_files_for(directory):
+        if directory not in ignore_files_cache:
+            ignore_files = ignore_files_for(directory.parent)
+            if use_ignore_files:
+                ignore_file = IgnoreFile.from_directory(directory)
+                if ignore_file is not None:
+                    ignore_files = (*ignore_files, ignore_file)
+            ignore_files_cache[directory] = ignore_files
+        return ignore_files_cache[directory]
+
+    def is_excluded(path, is_dir):
+        if is_dir and path in excluded_directories:
+            return excluded_directories[path]
+
+        parent = path.parent
+        if parent not in root and parent != root:
+            # Not underneath the root, so there's no chain of parents to check.
+            return False
+
+        excluded = (
+            is_excluded(parent, True) or
+            _is_excluded(path, is_dir, exclude, ignore_files_for(parent))
+        )
+        if is_dir:
+            excluded_directories[path] = excluded
+        return excluded
+
+    if use_ignore_files:
+        ignore_file = IgnoreFile.from_directory(root)
+        if ignore_file is not None:
+            ignore_files_cache[root] = (ignore_file,)
+
+    return is_excluded
+
+def _list_directory(directory, exclude, ignore_files, use_ignore_files):
+    '''
+    Return a list of (Path, is_dir, DirEntry) for the children of this
+    directory which are not excluded, and the tuple of IgnoreFiles that
+    applies to them.
+    '''
+    log.debug('Scanning %s.', directory.absolute_path)
+
+    try:
+        entries = list(os.scandir(directory))
+    except (OSError, PermissionError):
+        return ([], ignore_files)
+
+    if use_ignore_files:
+        ignore_file = IgnoreFile.from_directory(directory)
+        if ignore_file is not None:
+            ignore_files = (*ignore_files, ignore_file)
+
+    children = []
+    for entry in entries:
+        is_dir = entry.is_dir()
+        if not is_dir and not entry.is_file():
             continue
 
-        filepath = pathclass.Path(search_object)
-        if not filepath.is_file:
+        child = directory.with_child(entry.name)
+        if _is_excluded(child, is_dir, exclude, ignore_files):
             continue
 
-        if filepath.extension == 'lnk' and winshell:
-            yield from search_contents_windows_lnk(filepath, content_args)
-        if filepath.extension == 'srt' and pysrt:
-            yield from search_contents_srt(filepath, content_args)
-        else:
-            yield from search_contents_generic(filepath, content_args)
+        children.append((child, is_dir, entry))
+
+    return (children, ignore_files)
+
+def walk(
+        root_path,
+        *,
+        exclude=None,
+        filter_function=None,
+        recurse=True,
+        use_ignore_files=False,
+        yield_directories=True,
+        yield_files=True,
+    ):
+    '''
+    Yield pathclass.Path objects for the directories and files underneath the
+    root, like spinal.walk(yield_directories=True), except that excluded
+    items are pruned while walking. An excluded directory is never listed, so
+    none of its contents cost anything.
+
+    exclude:
+        A list of glob patterns or absolute paths. Items whose basename or
+        absolute path matches one of these are skipped.
+
+    filter_function:
+        A function which is called as filter_function(basename, is_dir, stat)
+        and returns whether the item should be yielded, where stat is the
+        DirEntry's stat method. Unlike exclude, this does not prevent walking
+        into directories. See compile_metadata_filter.
+
+    use_ignore_files:
+        If True, the .gitignore and .ignore files found along the way are
+        obeyed for their own directory and everything below it, and .git
+        directories are skipped.
+
+    yield_directories, yield_files:
+        Same as spinal.walk. These are answered by the DirEntry, so unlike
+        checking Path.is_file afterwards they don't cost a stat.
+    '''
+    exclude = _prepare_exclude(exclude, use_ignore_files)
+
+    root = pathclass.Path(root_path)
+    root.assert_is_directory()
+
+    pending = collections.deque()
+    pending.append((root, ()))
+    while pending:
+        (current, ignore_files) = pending.pop()
+        (children, ignore_files) = _list_directory(current, exclude, ignore_files, use_ignore_files)
+
+        # Same as spinal.walk, the subdirectories are pushed in reverse so
+        # they are popped in the order they were listed.
+        more_pending = collections.deque()
+        for (child, is_dir, entry) in children:
+            wanted = yield_directories if is_dir else yield_files
+            if wanted and (filter_function is None or filter_function(child.basename, is_dir, entry.stat)):
+                yield child
+            if is_dir and recurse:
+                more_pending.appendleft((child, ignore_files))
+
+        pending.extend(more_pending)
 
 def argparse_to_dict(args):
     text = args.text
@@ -278,22 +1805,57 @@ def argparse_to_dict(args):
         'not_any': args.not_any,
         'case_sensitive': args.case_sensitive,
         'content_args': content_args,
+        'context_after': args.context_after if args.context_after is not None else args.context,
+        'context_before': args.context_before if args.context_before is not None else args.context,
         'do_expression': args.do_expression,
         'do_glob': args.do_glob,
         'do_regex': args.do_regex,
         'do_strip': args.do_strip,
+        'exclude': args.exclude,
+        'extensions': args.extensions,
+        'index': args.index,
+        'index_refresh': args.index_refresh,
+        'jobs': args.jobs,
+        'larger_than': args.larger_than,
         'local_only': args.local_only,
         'line_numbers': args.line_numbers,
+        'max_results': args.max_results,
+        'newer_than': args.newer_than,
+        'older_than': args.older_than,
         'only_dirs': args.only_dirs,
         'only_files': args.only_files,
+        'ordered': not args.unordered,
+        'smaller_than': args.smaller_than,
         'text': text,
+        'use_ignore_files': args.use_ignore_files,
     }
 
 def _search_argparse(args):
-    generator = search(**argparse_to_dict(args))
+    srt_cache = args.srt_cache
+    if srt_cache is None and args.index:
+        # This must be a separate file, because the index is still reading
+        # from its own connection when the srt cache wants to commit.
+        srt_cache = args.index + '.srtcache'
+    elif srt_cache and args.index and pathclass.Path(srt_cache) == pathclass.Path(args.index):
+        raise ValueError('--srt_cache must be a different file than --index.')
+    if srt_cache:
+        SRT_CACHE.open_database(srt_cache)
+
+    kwargs = argparse_to_dict(args)
+    if args.watch:
+        generator = search_watch(interval=args.watch_interval, **kwargs)
+    else:
+        generator = search_results(**kwargs)
+
+    if not args.jsonl:
+        generator = format_results(generator, **kwargs)
+
     result_count = 0
     for result in generator:
-        safeprint.safeprint(result)
+        if args.jsonl:
+            safeprint.safeprint(json.dumps(result.jsonify()))
+        else:
+            safeprint.safeprint(result)
         result_count += 1
     if args.show_count:
         print('%d items.' % result_count)
@@ -334,15 +1896,34 @@ def main(argv):
     parser.add_argument('--not_any', '--not-any', nargs='+', default=[])
 
     parser.add_argument('--strip', dest='do_strip', action='store_true')
+    parser.add_argument('--after', dest='context_after', type=int, default=None)
+    parser.add_argument('--before', dest='context_before', type=int, default=None)
+    parser.add_argument('--context', type=int, default=0)
     parser.add_argument('--case', dest='case_sensitive', action='store_true')
     parser.add_argument('--content', dest='do_content', action='store_true')
     parser.add_argument('--count', dest='show_count', action='store_true')
+    parser.add_argument('--exclude', nargs='+', default=[])
     parser.add_argument('--expression', dest='do_expression', action='store_true')
+    parser.add_argument('--ext', dest='extensions', nargs='+', default=None)
+    parser.add_argument('--gitignore', dest='use_ignore_files', action='store_true')
     parser.add_argument('--glob', dest='do_glob', action='store_true')
+    parser.add_argument('--index', default=None)
+    parser.add_argument('--refresh', dest='index_refresh', action='store_true')
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--jsonl', action='store_true')
+    parser.add_argument('--larger_than', '--larger-than', type=bytestring.parsebytes, default=None)
     parser.add_argument('--line_numbers', '--line-numbers', action='store_true')
     parser.add_argument('--local', dest='local_only', action='store_true')
+    parser.add_argument('--newer_than', '--newer-than', type=parse_time, default=None)
+    parser.add_argument('--older_than', '--older-than', type=parse_time, default=None)
+    parser.add_argument('--max_per_file', '--max-per-file', dest='max_results', type=int, default=None)
     parser.add_argument('--regex', dest='do_regex', action='store_true')
+    parser.add_argument('--smaller_than', '--smaller-than', type=bytestring.parsebytes, default=None)
+    parser.add_argument('--srt_cache', '--srt-cache', default=None)
     parser.add_argument('--text', default=None)
+    parser.add_argument('--unordered', action='store_true')
+    parser.add_argument('--watch', action='store_true')
+    parser.add_argument('--watch_interval', '--watch-interval', type=float, default=5)
     parser.add_argument('--dirs', '--folders', dest='only_dirs', action='store_true')
     parser.add_argument('--files', dest='only_files', action='store_true')
     parser.set_defaults(func=search_argparse)
@@ -1,16 +1,28 @@
 import argparse
 import ast
+import asyncio
+import collections
+import contextlib
+import http.server
+import json
 import os
 import random
 import shutil
+import sqlite3
+import ssl
 import sys
 import threading
 import time
 import traceback
+import urllib.parse
+import urllib.request
 
+from voussoirkit import backoff
 from voussoirkit import betterhelp
 from voussoirkit import bytestring
+from voussoirkit import dotdict
 from voussoirkit import downloady
+from voussoirkit import httperrors
 from voussoirkit import pathclass
 from voussoirkit import pipeable
 from voussoirkit import ratelimiter
@@ -21,6 +33,824 @@ from voussoirkit import vlogging
 log = vlogging.getLogger(__name__, 'threaded_dl')
 downloady.log.setLevel(vlogging.WARNING)
 
+# Segmented downloads use their own temp extension, because their temp file is
+# preallocated to the full size and would look finished to downloady's resume.
+SEGMENTED_TEMP_EXTENSION = '.segmentedtemp'
+
+MANIFEST_DB_INIT = '''
+BEGIN;
+CREATE TABLE IF NOT EXISTS downloads(
+    url TEXT PRIMARY KEY NOT NULL,
+    filename TEXT NOT NULL,
+    state TEXT NOT NULL,
+    bytes INT NOT NULL,
+    total_bytes INT,
+    etag TEXT,
+    error TEXT,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS segments(
+    url TEXT NOT NULL,
+    first_byte INT NOT NULL,
+    last_byte INT NOT NULL,
+    done INT NOT NULL,
+    PRIMARY KEY(url, first_byte)
+);
+COMMIT;
+'''
+
+class Manifest:
+    '''
+    Records the state of each url in the batch, so that running the same link
+    list again resumes where the last run left off. Each url keeps the
+    filename it was first given, even if the filename_format has {now} or
+    {random} in it. Finished downloads are skipped, partial files are resumed
+    if the server's ETag and size haven't changed, and failures are retried.
+
+    The states are pending, downloading, done, and failed. For segmented
+    downloads, each segment is recorded as it finishes.
+    '''
+    def __init__(self, path):
+        self.sql = sqlite3.connect(path, check_same_thread=False)
+        self.sql.executescript(MANIFEST_DB_INIT)
+        self.lock = threading.Lock()
+
+    def _update(self, url, **fields):
+        fields['updated'] = time.time()
+        assignments = ', '.join(f'{key} = ?' for key in fields)
+        with self.lock:
+            self.sql.execute(
+                f'UPDATE downloads SET {assignments} WHERE url == ?',
+                [*fields.values(), url]
+            )
+            self.sql.commit()
+
+    def add_pending(self, urls_filenames):
+        now = time.time()
+        with self.lock:
+            self.sql.executemany(
+                '''
+                INSERT INTO downloads VALUES(?, ?, 'pending', 0, NULL, NULL, NULL, ?)
+                ON CONFLICT(url) DO NOTHING
+                ''',
+                [(url, filename, now) for (url, filename) in urls_filenames]
+            )
+            self.sql.commit()
+
+    def get(self, url):
+        with self.lock:
+            cur = self.sql.execute(
+                '''
+                SELECT filename, state, bytes, total_bytes, etag, error
+                FROM downloads WHERE url == ?
+                ''',
+                [url]
+            )
+            row = cur.fetchone()
+        if row is None:
+            return None
+        keys = ['filename', 'state', 'bytes', 'total_bytes', 'etag', 'error']
+        return dotdict.DotDict(zip(keys, row))
+
+    def get_segments(self, url):
+        '''
+        Return a list of (first_byte, last_byte, done) for the url.
+        '''
+        with self.lock:
+            cur = self.sql.execute(
+                'SELECT first_byte, last_byte, done FROM segments WHERE url == ? ORDER BY first_byte',
+                [url]
+            )
+            return cur.fetchall()
+
+    def set_done(self, url, total_bytes):
+        self._update(url, state='done', bytes=total_bytes, error=None)
+
+    def set_failed(self, url, bytes, error):
+        self._update(url, state='failed', bytes=bytes, error=error)
+
+    def set_segment_done(self, url, first_byte, bytes):
+        with self.lock:
+            self.sql.execute(
+                'UPDATE segments SET done = 1 WHERE url == ? AND first_byte == ?',
+                [url, first_byte]
+            )
+            self.sql.commit()
+        self._update(url, bytes=bytes)
+
+    def set_segments(self, url, segments):
+        with self.lock:
+            self.sql.execute('DELETE FROM segments WHERE url == ?', [url])
+            self.sql.executemany(
+                'INSERT INTO segments VALUES(?, ?, ?, 0)',
+                [(url, first_byte, last_byte) for (first_byte, last_byte) in segments]
+            )
+            self.sql.commit()
+
+    def set_started(self, url, total_bytes, etag):
+        self._update(url, state='downloading', total_bytes=total_bytes, etag=etag)
+
+# The asyncio engine follows this many redirects before giving up.
+MAX_REDIRECTS = 20
+
+class AsyncConnectionPool:
+    '''
+    Keeps the idle keep-alive connections for each (scheme, host, port), so
+    that many small downloads from the same server don't each pay for a new
+    TCP and TLS handshake, and limits how many downloads can be in flight to
+    each host at once.
+    '''
+    def __init__(self, per_host=None, timeout=None):
+        self.per_host = per_host
+        self.timeout = timeout
+        self.idle = collections.defaultdict(list)
+        self.semaphores = {}
+        self.ssl_context = ssl.create_default_context()
+
+    def close(self):
+        for connections in self.idle.values():
+            for (reader, writer) in connections:
+                writer.close()
+        self.idle.clear()
+
+    async def open(self, key):
+        '''
+        Return (reader, writer, reused) for a connection to the key, reusing an
+        idle one if we have it.
+        '''
+        idle = self.idle[key]
+        while idle:
+            (reader, writer) = idle.pop()
+            if reader.at_eof() or writer.is_closing():
+                writer.close()
+                continue
+            return (reader, writer, True)
+
+        (scheme, host, port) = key
+        context = self.ssl_context if scheme == 'https' else None
+        connect = asyncio.open_connection(host, port, ssl=context)
+        (reader, writer) = await asyncio.wait_for(connect, self.timeout)
+        return (reader, writer, False)
+
+    def release(self, key, reader, writer, reusable):
+        if reusable:
+            self.idle[key].append((reader, writer))
+        else:
+            writer.close()
+
+    def semaphore(self, host):
+        if self.per_host is None:
+            return contextlib.nullcontext()
+        semaphore = self.semaphores.get(host)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.per_host)
+            self.semaphores[host] = semaphore
+        return semaphore
+
+class AsyncDownloader:
+    '''
+    Downloads many urls concurrently on a single asyncio event loop instead of
+    one thread per download, so thousands of downloads can be in flight at
+    once. This speaks plain HTTP/1.1 over asyncio streams, with keep-alive
+    connections pooled per host and an optional cap on the concurrent
+    downloads for each host.
+
+    The Ratelimiter and RateMeter are shared with the rest of the program,
+    same as the threaded engine.
+    '''
+    def __init__(
+            self,
+            *,
+            bytespersecond=None,
+            concurrency,
+            headers=None,
+            manifest=None,
+            meter=None,
+            metrics=None,
+            per_host=None,
+            timeout=None,
+        ):
+        self.bytespersecond = bytespersecond
+        self.concurrency = concurrency
+        self.headers = headers or {}
+        self.manifest = manifest
+        self.meter = meter
+        self.metrics = metrics
+        self.timeout = timeout
+        self.connections = AsyncConnectionPool(per_host=per_host, timeout=timeout)
+        # Matches the attribute of threadpool.ThreadPool that the ui reads.
+        self.running_count = 0
+
+    async def _limit(self, cost):
+        # Same as Ratelimiter.limit, except we sleep without blocking the
+        # event loop.
+        limiter = self.bytespersecond
+        with limiter.lock:
+            (success, sleep_needed) = limiter._limit(cost)
+        if sleep_needed > 0:
+            await asyncio.sleep(sleep_needed)
+
+    async def _read_line(self, reader):
+        return await asyncio.wait_for(reader.readline(), self.timeout)
+
+    async def _read_head(self, reader):
+        status_line = await self._read_line(reader)
+        if not status_line:
+            raise ConnectionResetError('The server closed the connection.')
+
+        (version, status) = status_line.decode('latin-1').split(' ', 2)[:2]
+        response_headers = {}
+        while True:
+            line = await self._read_line(reader)
+            if line in {b'\r\n', b'\n', b''}:
+                break
+            (key, value) = line.decode('latin-1').split(':', 1)
+            response_headers[key.strip().lower()] = value.strip()
+        return (version, int(status), response_headers)
+
+    async def _read_body(self, reader, response_headers, chunk_size=128 * bytestring.KIBIBYTE):
+        '''
+        Yield the chunks of the response body, whether it is framed by
+        Content-Length, chunked transfer encoding, or the closing of the
+        connection.
+        '''
+        if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size_line = await self._read_line(reader)
+                size = int(size_line.split(b';')[0], 16)
+                if size == 0:
+                    # Skip the trailers.
+                    while (await self._read_line(reader)) not in {b'\r\n', b'\n', b''}:
+                        pass
+                    return
+                while size > 0:
+                    chunk = await asyncio.wait_for(reader.read(min(size, chunk_size)), self.timeout)
+                    if not chunk:
+                        raise downloady.NotEnoughBytes('The connection closed mid-chunk.')
+                    size -= len(chunk)
+                    yield chunk
+                await asyncio.wait_for(reader.readexactly(2), self.timeout)
+
+        elif 'content-length' in response_headers:
+            remaining = int(response_headers['content-length'])
+            while remaining > 0:
+                chunk = await asyncio.wait_for(reader.read(min(remaining, chunk_size)), self.timeout)
+                if not chunk:
+                    message = f'The connection closed with {remaining} bytes left.'
+                    raise downloady.NotEnoughBytes(message)
+                remaining -= len(chunk)
+                yield chunk
+
+        else:
+            while True:
+                chunk = await asyncio.wait_for(reader.read(chunk_size), self.timeout)
+                if not chunk:
+                    return
+                yield chunk
+
+    def _request_bytes(self, parts, request_headers):
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        # Not parts.netloc, which would put any user:password@ on the wire.
+        host = parts.hostname
+        if ':' in host:
+            host = f'[{host}]'
+        if parts.port is not None:
+            host = f'{host}:{parts.port}'
+
+        headers = {'Host': host}
+        headers.update(downloady.HEADERS)
+        headers.update(request_headers)
+        headers['Accept-Encoding'] = 'identity'
+        headers['Connection'] = 'keep-alive'
+
+        lines = [f'GET {path} HTTP/1.1']
+        lines.extend(f'{key}: {value}' for (key, value) in headers.items())
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    async def _request(self, key, parts, headers):
+        '''
+        Send the request and read the response head. If a pooled connection
+        turns out to have been closed by the server while it sat idle, try
+        again on a new connection.
+        '''
+        while True:
+            (reader, writer, reused) = await self.connections.open(key)
+            try:
+                writer.write(self._request_bytes(parts, headers))
+                await writer.drain()
+                (version, status, response_headers) = await self._read_head(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            return (reader, writer, version, status, response_headers)
+
+    async def download(self, url, filename, meter=None):
+        temp_filename = filename + downloady.TEMP_EXTENSION
+        location = url
+        headers = dict(self.headers)
+        previous = None
+        for redirect in range(MAX_REDIRECTS):
+            parts = urllib.parse.urlsplit(location)
+            port = parts.port or (443 if parts.scheme == 'https' else 80)
+            key = (parts.scheme, parts.hostname, port)
+
+            if previous is not None and (previous.scheme, previous.hostname) != (parts.scheme, parts.hostname):
+                # Same as requests, don't hand the user's credentials to
+                # whatever host we have been redirected to.
+                headers = {
+                    name: value for (name, value) in headers.items()
+                    if name.lower() not in {'authorization', 'cookie'}
+                }
+            previous = parts
+
+            (reader, writer, version, status, response_headers) = await self._request(key, parts, headers)
+            reusable = (
+                version == 'HTTP/1.1' and
+                response_headers.get('connection', '').lower() != 'close' and
+                (
+                    'content-length' in response_headers or
+                    response_headers.get('transfer-encoding', '').lower() == 'chunked'
+                )
+            )
+            try:
+                if status in {301, 302, 303, 307, 308} and 'location' in response_headers:
+                    async for chunk in self._read_body(reader, response_headers):
+                        pass
+                    location = urllib.parse.urljoin(location, response_headers['location'])
+                    continue
+
+                if status >= 400:
+                    reusable = False
+                    default = httperrors.HTTP5XX if status >= 500 else httperrors.HTTP4XX
+                    cls = getattr(httperrors, f'HTTP{status}', default)
+                    raise cls(f'{status} for url {location}')
+
+                if self.manifest is not None:
+                    total_bytes = response_headers.get('content-length', None)
+                    total_bytes = None if total_bytes is None else int(total_bytes)
+                    self.manifest.set_started(url, total_bytes=total_bytes, etag=response_headers.get('etag'))
+
+                os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+                with open(temp_filename, 'wb') as handle:
+                    async for chunk in self._read_body(reader, response_headers):
+                        handle.write(chunk)
+                        if self.bytespersecond is not None:
+                            await self._limit(len(chunk))
+                        if meter is not None:
+                            meter.digest(len(chunk))
+            except BaseException:
+                reusable = False
+                raise
+            finally:
+                self.connections.release(key, reader, writer, reusable)
+
+            os.replace(temp_filename, filename)
+            return
+
+        raise downloady.DownloadyException(f'{url} redirected more than {MAX_REDIRECTS} times.')
+
+    async def _download_job(self, url, filename, concurrency, job_metrics=None):
+        # Take the host's slot before the global slot, so that the downloads
+        # waiting on a busy host don't hold up the downloads from other hosts.
+        async with self.connections.semaphore(urllib.parse.urlsplit(url).hostname):
+            async with concurrency:
+                self.running_count += 1
+                log.info(f'Starting "{filename}"')
+                if job_metrics is not None:
+                    job_metrics.start()
+                try:
+                    await self.download(url, filename, meter=job_metrics or self.meter)
+                except Exception as exc:
+                    log.error(f'"{filename}" failed: {describe_exception(exc)}')
+                    if job_metrics is not None:
+                        job_metrics.finish(exc)
+                    if self.manifest is not None:
+                        self.manifest.set_failed(url, bytes=0, error=describe_exception(exc))
+                    return 1
+                finally:
+                    self.running_count -= 1
+
+        if job_metrics is not None:
+            job_metrics.finish()
+        if self.manifest is not None:
+            self.manifest.set_done(url, os.path.getsize(filename))
+        log.info(f'Finished "{filename}"')
+        return 0
+
+    async def _run(self, urls_filenames):
+        concurrency = asyncio.Semaphore(self.concurrency)
+        try:
+            statuses = await asyncio.gather(*(
+                self._download_job(
+                    url,
+                    filename,
+                    concurrency,
+                    job_metrics=None if self.metrics is None else self.metrics.add_job(filename, url),
+                )
+                for (url, filename) in urls_filenames
+            ))
+        finally:
+            self.connections.close()
+        return 1 if any(statuses) else 0
+
+    def run(self, urls_filenames):
+        '''
+        Download all of the (url, filename) and return 0 if they all succeeded,
+        or 1 if any failed.
+        '''
+        return asyncio.run(self._run(urls_filenames))
+
+def describe_exception(exc):
+    return f'{type(exc).__name__}: {exc}'
+
+class SegmentedDownload:
+    '''
+    A large file which is downloaded as several HTTP Range segments at the same
+    time, by different threads of the pool. The temp file is preallocated to
+    the full size, and each segment writes into its own region of it through
+    its own handle, so the segments can finish in any order. Whichever segment
+    finishes last renames the temp file into place.
+    '''
+    def __init__(self, url, filename, total_bytes, segment_size, manifest=None):
+        self.url = url
+        self.filename = filename
+        self.temp_filename = filename + SEGMENTED_TEMP_EXTENSION
+        self.total_bytes = total_bytes
+        self.manifest = manifest
+        self.segments = [
+            (start, min(start + segment_size, total_bytes) - 1)
+            for start in range(0, total_bytes, segment_size)
+        ]
+        self.done_bytes = 0
+        self.lock = threading.Lock()
+
+    def resume(self, segments):
+        '''
+        Given the (first_byte, last_byte, done) segments from a previous run,
+        only download the ones that weren't done.
+        '''
+        self.segments = [(first, last) for (first, last, done) in segments if not done]
+        self.done_bytes = sum(last - first + 1 for (first, last, done) in segments if done)
+        log.info(f'Resuming "{self.filename}" with {len(self.segments)} segments left.')
+
+    @property
+    def remaining(self):
+        return len(self.segments)
+
+    def preallocate(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        with open(self.temp_filename, 'ab') as handle:
+            handle.truncate(self.total_bytes)
+
+    def segment_failed(self, exc):
+        if self.manifest is not None:
+            with self.lock:
+                done_bytes = self.done_bytes
+            self.manifest.set_failed(self.url, bytes=done_bytes, error=describe_exception(exc))
+
+    def segment_finished(self, start, end):
+        with self.lock:
+            self.segments.remove((start, end))
+            self.done_bytes += end - start + 1
+            done_bytes = self.done_bytes
+            finished = not self.segments
+
+        if self.manifest is not None:
+            self.manifest.set_segment_done(self.url, start, bytes=done_bytes)
+
+        if finished:
+            self.finish()
+
+    def finish(self):
+        os.replace(self.temp_filename, self.filename)
+        if self.manifest is not None:
+            self.manifest.set_done(self.url, self.total_bytes)
+        log.info(f'Finished "{self.filename}"')
+
+# With --auto, a download that gets 429 or 503 is retried this many times,
+# after waiting for the server's Retry-After or our own backoff.
+THROTTLE_RETRIES = 5
+
+class ConcurrencyController:
+    '''
+    Decides how many of the pool's threads are allowed to download at once,
+    for --auto. Every interval, it looks at the RateMeter's throughput:
+
+    - If raising the limit raised the throughput by more than the threshold,
+      raise it again.
+    - If it didn't, we have found the point where throughput levels off, so go
+      back to the previous limit and hold there. Every few intervals we try
+      one more, in case conditions have changed.
+    - If the server responded 429 or 503, or most downloads are failing, cut
+      the limit in half.
+    '''
+    def __init__(self, meter, maximum, *, interval=5, threshold=0.1):
+        self.meter = meter
+        self.maximum = maximum
+        self.interval = interval
+        self.threshold = threshold
+
+        self.limit = min(2, maximum)
+        self.active = 0
+        self.condition = threading.Condition()
+
+        self.throttles = 0
+        self.failures = 0
+        self.successes = 0
+
+        # The (limit, rate) we measured before the last time we raised the
+        # limit, so we can tell if the raise helped.
+        self.previous = None
+        self.holding = 0
+
+    def acquire(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    def release(self, failed=False, throttled=False):
+        with self.condition:
+            self.active -= 1
+            if throttled:
+                self.throttles += 1
+            elif failed:
+                self.failures += 1
+            else:
+                self.successes += 1
+            self.condition.notify_all()
+
+    def _set_limit(self, limit, reason):
+        limit = max(1, min(limit, self.maximum))
+        if limit == self.limit:
+            return
+        log.info(f'Adjusting to {limit} threads because {reason}.')
+        with self.condition:
+            self.limit = limit
+            self.condition.notify_all()
+
+    def adjust(self):
+        rate = self.meter.report()[2]
+        with self.condition:
+            (throttles, failures, successes) = (self.throttles, self.failures, self.successes)
+            self.throttles = self.failures = self.successes = 0
+            saturated = self.active >= self.limit
+
+        if throttles:
+            self.previous = None
+            self.holding = 0
+            self._set_limit(self.limit // 2, 'the server is throttling us')
+            return
+
+        if failures > successes:
+            self.previous = None
+            self.holding = 0
+            self._set_limit(self.limit // 2, 'most downloads are failing')
+            return
+
+        # If there aren't enough jobs to fill the current limit, the rate
+        # tells us nothing about the limit.
+        if not saturated:
+            return
+
+        if self.previous is not None:
+            (previous_limit, previous_rate) = self.previous
+            if rate < previous_rate * (1 + self.threshold):
+                self.previous = None
+                self.holding = 1
+                self._set_limit(previous_limit, 'more threads did not increase the speed')
+                return
+
+        if self.holding:
+            self.holding = (self.holding + 1) % 6
+            if self.holding:
+                return
+            # Try one more.
+            self.previous = (self.limit, rate)
+            self._set_limit(self.limit + 1, 'it has been a while since we tried more')
+            return
+
+        if self.limit >= self.maximum:
+            return
+
+        self.previous = (self.limit, rate)
+        self._set_limit(max(self.limit + 1, int(self.limit * 1.5)), 'more threads increased the speed')
+
+    def run_forever(self, stop_event):
+        while not stop_event.wait(timeout=self.interval):
+            self.adjust()
+
+def auto_job(controller, function, **kwargs):
+    '''
+    Run the download function once the controller has a free slot. If the
+    server says it's overloaded, give up the slot, wait, and try again.
+    '''
+    throttle_backoff = backoff.Exponential(a=2, b=1, max=120)
+    for attempt in range(THROTTLE_RETRIES + 1):
+        controller.acquire()
+        try:
+            value = function(**kwargs)
+        except (httperrors.HTTP429, httperrors.HTTP503) as exc:
+            controller.release(throttled=True)
+            if attempt == THROTTLE_RETRIES:
+                raise
+            if isinstance(kwargs.get('meter'), JobMetrics):
+                kwargs['meter'].retries += 1
+            delay = throttle_backoff.next()
+            retry_after = exc.response.headers.get('retry-after', '') if exc.response is not None else ''
+            if retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            log.info(f'Server responded {type(exc).__name__}, retrying in {delay} seconds.')
+            time.sleep(delay)
+        except BaseException:
+            controller.release(failed=True)
+            raise
+        else:
+            controller.release()
+            return value
+
+class JobMetrics:
+    '''
+    The statistics of a single download job. This object is given to the
+    download functions in place of the RateMeter, so that it sees every chunk,
+    and it passes them along to the real RateMeter.
+    '''
+    def __init__(self, name, url, meter=None):
+        self.name = name
+        self.url = url
+        self.meter = meter
+        self.state = 'queued'
+        self.bytes = 0
+        self.retries = 0
+        self.error = None
+        self.started = None
+        self.first_byte = None
+        self.finished = None
+
+    def digest(self, value):
+        if self.first_byte is None:
+            self.first_byte = time.monotonic()
+        self.bytes += value
+        if self.meter is not None:
+            self.meter.digest(value)
+
+    def finish(self, exc=None):
+        self.finished = time.monotonic()
+        if exc is None:
+            self.state = 'done'
+        else:
+            self.state = 'failed'
+            self.error = describe_exception(exc)
+
+    def start(self):
+        # When auto_job retries, the job starts again and we measure the time
+        # to first byte of the new attempt.
+        self.started = time.monotonic()
+        self.first_byte = None
+        self.finished = None
+        self.error = None
+        self.state = 'running'
+
+    def to_json(self):
+        now = time.monotonic()
+        if self.first_byte is not None:
+            rate = self.bytes / max((self.finished or now) - self.first_byte, 0.001)
+        else:
+            rate = 0
+        return {
+            'name': self.name,
+            'url': self.url,
+            'state': self.state,
+            'bytes': self.bytes,
+            'rate': rate,
+            'time_to_first_byte': (
+                None if self.first_byte is None else self.first_byte - self.started
+            ),
+            'elapsed': None if self.started is None else (self.finished or now) - self.started,
+            'retries': self.retries,
+            'error': self.error,
+        }
+
+class Metrics:
+    '''
+    Collects the JobMetrics of the whole batch for --metrics_file and
+    --metrics_port. The report has the totals, the number of queued, running,
+    finished, and failed jobs, the bytes, speed, and average time to first
+    byte of each host so that slow hosts stand out, and the details of the
+    running and failed jobs and the most recently finished ones.
+    '''
+    # How many of the finished jobs to include in the report.
+    recent = 100
+
+    def __init__(self, meter, controller=None):
+        self.meter = meter
+        self.controller = controller
+        self.jobs = []
+        self.started = time.monotonic()
+
+    def add_job(self, name, url):
+        job = JobMetrics(name, url, meter=self.meter)
+        self.jobs.append(job)
+        return job
+
+    def to_json(self):
+        jobs = list(self.jobs)
+        states = collections.Counter(job.state for job in jobs)
+
+        hosts = {}
+        for job in jobs:
+            if job.started is None:
+                continue
+            host = hosts.setdefault(
+                urllib.parse.urlsplit(job.url).hostname,
+                {'jobs': 0, 'failed': 0, 'retries': 0, 'bytes': 0, 'seconds': 0, 'ttfb': []},
+            )
+            host['jobs'] += 1
+            host['failed'] += job.state == 'failed'
+            host['retries'] += job.retries
+            host['bytes'] += job.bytes
+            if job.first_byte is not None:
+                host['seconds'] += (job.finished or time.monotonic()) - job.first_byte
+                host['ttfb'].append(job.first_byte - job.started)
+
+        for host in hosts.values():
+            ttfb = host.pop('ttfb')
+            host['average_time_to_first_byte'] = (sum(ttfb) / len(ttfb)) if ttfb else None
+            host['rate'] = host['bytes'] / host.pop('seconds') if host['bytes'] else 0
+
+        finished = [job for job in jobs if job.state == 'done']
+        finished.sort(key=lambda job: job.finished)
+        listed = [job for job in jobs if job.state in {'running', 'failed'}]
+        listed.extend(finished[-self.recent:])
+
+        report = {
+            'time': time.time(),
+            'elapsed': time.monotonic() - self.started,
+            'bytes': sum(job.bytes for job in jobs),
+            'rate': self.meter.report()[2],
+            'queued': states['queued'],
+            'running': states['running'],
+            'done': states['done'],
+            'failed': states['failed'],
+            'retries': sum(job.retries for job in jobs),
+            'hosts': hosts,
+            'jobs': [job.to_json() for job in listed],
+        }
+        if self.controller is not None:
+            report['thread_limit'] = self.controller.limit
+        return report
+
+    def serve_forever(self, port):
+        '''
+        Serve the report as JSON on localhost.
+        '''
+        metrics = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(metrics.to_json(), indent=4).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug(format, *args)
+
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        server.daemon_threads = True
+        log.info(f'Serving metrics on http://127.0.0.1:{port}')
+        server.serve_forever()
+
+    def write(self, filename):
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'w', encoding='utf-8') as handle:
+            json.dump(self.to_json(), handle, indent=4)
+        os.replace(temp_filename, filename)
+
+    def write_forever(self, filename, stop_event, interval=5):
+        while not stop_event.wait(timeout=interval):
+            self.write(filename)
+
+def measured_job(job_metrics, wrapped, **kwargs):
+    # The wrapped function is not called `function` because auto_job uses
+    # that name when it wraps this job.
+    job_metrics.start()
+    try:
+        value = wrapped(**kwargs)
+    except BaseException as exc:
+        job_metrics.finish(exc)
+        raise
+    job_metrics.finish()
+    return value
+
 def clean_url_list(urls):
     for url in urls:
         if isinstance(url, (tuple, list)):
@@ -40,24 +870,104 @@ def clean_url_list(urls):
         else:
             yield url
 
+def download_segment_job(
+        download,
+        start,
+        end,
+        *,
+        bytespersecond=None,
+        headers=None,
+        meter=None,
+        timeout=None,
+    ):
+    try:
+        _download_segment(
+            download,
+            start,
+            end,
+            bytespersecond=bytespersecond,
+            headers=headers,
+            meter=meter,
+            timeout=timeout,
+        )
+    except Exception as exc:
+        download.segment_failed(exc)
+        raise
+
+    download.segment_finished(start, end)
+
+def _download_segment(download, start, end, *, bytespersecond, headers, meter, timeout):
+    headers = dict(headers or {})
+    headers['range'] = f'bytes={start}-{end}'
+    response = downloady.request('get', download.url, stream=True, headers=headers, timeout=timeout)
+    if response.status_code != 206:
+        response.close()
+        raise downloady.ServerNoRange(f'{download.url} did not respect the range {start}-{end}.')
+
+    if bytespersecond is not None:
+        chunk_size = int(bytespersecond.allowance * downloady.IDEAL_CHUNK_TIME)
+    else:
+        chunk_size = 128 * bytestring.KIBIBYTE
+
+    position = start
+    with open(download.temp_filename, 'r+b') as handle:
+        handle.seek(start)
+        while True:
+            chunk_start = time.perf_counter()
+            chunk = response.raw.read(chunk_size)
+            if not chunk:
+                break
+
+            handle.write(chunk)
+            position += len(chunk)
+
+            if bytespersecond is not None:
+                bytespersecond.limit(len(chunk))
+
+            if meter is not None:
+                meter.digest(len(chunk))
+
+            chunk_time = time.perf_counter() - chunk_start
+            chunk_size = downloady.dynamic_chunk_sizer(chunk_size, chunk_time, downloady.IDEAL_CHUNK_TIME)
+
+    response.close()
+
+    if position != end + 1:
+        message = f'Segment {start}-{end} of "{download.filename}" ended at {position}.'
+        raise downloady.NotEnoughBytes(message)
+
 def download_job(
         url,
         filename,
         *,
         bytespersecond=None,
         headers=None,
+        manifest=None,
         meter=None,
         timeout=None,
     ):
     log.info(f'Starting "{filename}"')
-    downloady.download_file(
-        url,
-        filename,
-        bytespersecond=bytespersecond,
-        headers=headers,
-        ratemeter=meter,
-        timeout=timeout,
-    )
+    try:
+        if manifest is not None:
+            prepare_resume(url, filename, manifest, headers=headers, timeout=timeout)
+
+        downloady.download_file(
+            url,
+            filename,
+            bytespersecond=bytespersecond,
+            headers=headers,
+            ratemeter=meter,
+            timeout=timeout,
+        )
+    except Exception as exc:
+        if manifest is not None:
+            temp_filename = filename + downloady.TEMP_EXTENSION
+            partial_bytes = os.path.getsize(temp_filename) if os.path.exists(temp_filename) else 0
+            manifest.set_failed(url, bytes=partial_bytes, error=describe_exception(exc))
+        raise
+
+    if manifest is not None:
+        manifest.set_done(url, os.path.getsize(filename) if os.path.isfile(filename) else 0)
     log.info(f'Finished "{filename}"')
 
 def normalize_headers(headers):
@@ -92,7 +1002,92 @@ def normalize_headers(headers):
 
     return headers
 
-def prepare_urls_filenames(urls, filename_format):
+def plan_segments(pool, urls_filenames, segment_size, headers=None, manifest=None, timeout=None):
+    '''
+    Probe each url to find out its size and whether the server supports
+    ranges. Return the list of (url, filename) which should be downloaded in
+    one stream, and the list of SegmentedDownloads for the rest.
+    '''
+    kwargss = [
+        {
+            'function': probe_url,
+            'kwargs': {'url': url, 'headers': headers, 'timeout': timeout},
+        }
+        for (url, filename) in urls_filenames
+        if not downloady.is_special_file(filename)
+    ]
+    if not kwargss:
+        return (urls_filenames, [])
+
+    pool.add_many(kwargss)
+    probes = {}
+    for job in pool.result_generator():
+        if job.exception:
+            # Leave it to the regular download to fail and report the error.
+            continue
+        probes[job.kwargs['url']] = job.value
+
+    single = []
+    segmented = []
+    for (url, filename) in urls_filenames:
+        probe = probes.get(url)
+        if probe is None or not probe.respects_range:
+            single.append((url, filename))
+            continue
+        if probe.total_bytes is None or probe.total_bytes <= segment_size:
+            single.append((url, filename))
+            continue
+
+        download = SegmentedDownload(url, filename, probe.total_bytes, segment_size, manifest=manifest)
+        if manifest is None:
+            log.info(f'Downloading "{filename}" in {len(download.segments)} segments.')
+        elif can_resume(manifest.get(url), probe, download.temp_filename):
+            download.resume(manifest.get_segments(url))
+            manifest.set_started(url, total_bytes=probe.total_bytes, etag=probe.etag)
+        else:
+            log.info(f'Downloading "{filename}" in {len(download.segments)} segments.')
+            manifest.set_segments(url, download.segments)
+            manifest.set_started(url, total_bytes=probe.total_bytes, etag=probe.etag)
+        download.preallocate()
+        if download.remaining == 0:
+            # The last run crashed after the last segment but before renaming.
+            download.finish()
+            continue
+        segmented.append(download)
+    return (single, segmented)
+
+def can_resume(entry, probe, temp_filename):
+    '''
+    Return True if the partial file from a previous run is still good, that
+    is, the server's file has the same size and ETag as when it was started.
+    '''
+    if entry is None or entry.state not in {'downloading', 'failed'}:
+        return False
+
+    if not os.path.exists(temp_filename):
+        return False
+
+    return (entry.total_bytes, entry.etag) == (probe.total_bytes, probe.etag)
+
+def prepare_resume(url, filename, manifest, headers=None, timeout=None):
+    '''
+    Before a single-stream download, delete the partial file from a previous
+    run if the server's file has changed since, because downloady would
+    otherwise resume it and stitch two different files together.
+    '''
+    probe = probe_url(url, headers=headers, timeout=timeout)
+    temp_filename = filename + downloady.TEMP_EXTENSION
+    if not os.path.exists(temp_filename):
+        pass
+    elif not probe.respects_range:
+        log.info(f'"{filename}" can\'t be resumed because the server doesn\'t support ranges.')
+        os.remove(temp_filename)
+    elif not can_resume(manifest.get(url), probe, temp_filename):
+        log.info(f'"{filename}" has changed on the server, starting over.')
+        os.remove(temp_filename)
+    manifest.set_started(url, total_bytes=probe.total_bytes, etag=probe.etag)
+
+def prepare_urls_filenames(urls, filename_format, manifest=None):
     now = int(time.time())
 
     if os.path.normcase(filename_format) != os.devnull:
@@ -124,23 +1119,81 @@ def prepare_urls_filenames(urls, filename_format):
                 random=random.getrandbits(32),
             )
 
+        entry = None if manifest is None else manifest.get(url)
+        if entry is not None:
+            filename = entry.filename
+            if entry.state == 'done' and os.path.exists(filename):
+                log.info(f'Skipping finished file "{filename}"')
+                continue
+
         if os.path.exists(filename):
             log.info(f'Skipping existing file "{filename}"')
             continue
 
         urls_filenames.append((url, filename))
 
+    if manifest is not None:
+        manifest.add_pending(urls_filenames)
+
     return urls_filenames
 
+def probe_url(url, headers=None, timeout=None):
+    '''
+    Return a dotdict of total_bytes, respects_range, and etag for this url.
+    Like downloady, this uses a ranged GET instead of a HEAD because some
+    servers respond to HEAD differently.
+    '''
+    headers = dict(headers or {})
+    headers['range'] = 'bytes=0-'
+    response = downloady.request('get', url, stream=True, headers=headers, timeout=timeout)
+    response.close()
+
+    content_range = response.headers.get('content-range', '')
+    respects_range = response.status_code == 206 and '/' in content_range
+    if respects_range:
+        total_bytes = content_range.rsplit('/', 1)[1]
+    else:
+        total_bytes = response.headers.get('content-length', None)
+
+    try:
+        total_bytes = int(total_bytes)
+    except (TypeError, ValueError):
+        total_bytes = None
+
+    return dotdict.DotDict(
+        total_bytes=total_bytes,
+        respects_range=respects_range,
+        etag=response.headers.get('etag', None),
+    )
+
 def threaded_dl(
         urls,
         thread_count,
         filename_format,
+        auto=False,
         bytespersecond=None,
+        engine='threads',
         headers=None,
+        manifest=None,
+        metrics_file=None,
+        metrics_port=None,
+        per_host=None,
+        segment_size=None,
         timeout=None,
     ):
-    urls_filenames = prepare_urls_filenames(urls, filename_format)
+    if engine == 'async' and segment_size is not None:
+        raise ValueError('Segmented downloads are only supported by the threads engine.')
+
+    if engine == 'async' and auto:
+        raise ValueError('--auto is only supported by the threads engine.')
+
+    if engine == 'async' and urllib.request.getproxies():
+        log.warning('The async engine ignores the proxy environment variables and connects directly.')
+
+    if manifest is not None:
+        manifest = Manifest(manifest)
+
+    urls_filenames = prepare_urls_filenames(urls, filename_format, manifest=manifest)
 
     if not urls_filenames:
         return
@@ -153,11 +1206,52 @@ def threaded_dl(
         bytespersecond = ratelimiter.Ratelimiter(bytespersecond)
 
     meter = ratemeter.RateMeter(span=5)
+    ui_stop_event = threading.Event()
 
-    pool = threadpool.ThreadPool(thread_count, paused=True)
+    if auto:
+        controller = ConcurrencyController(meter, maximum=thread_count)
+        controller_thread = threading.Thread(
+            target=controller.run_forever,
+            args=[ui_stop_event],
+            daemon=True,
+        )
+        controller_thread.start()
+    else:
+        controller = None
+
+    if metrics_file is not None or metrics_port is not None:
+        metrics = Metrics(meter, controller=controller)
+    else:
+        metrics = None
+
+    if metrics_file is not None:
+        metrics_thread = threading.Thread(
+            target=metrics.write_forever,
+            args=[metrics_file, ui_stop_event],
+            daemon=True,
+        )
+        metrics_thread.start()
+
+    if metrics_port is not None:
+        server_thread = threading.Thread(target=metrics.serve_forever, args=[metrics_port], daemon=True)
+        server_thread.start()
+
+    if engine == 'async':
+        pool = AsyncDownloader(
+            bytespersecond=bytespersecond,
+            concurrency=thread_count,
+            headers=headers,
+            manifest=manifest,
+            meter=meter,
+            metrics=metrics,
+            per_host=per_host,
+            timeout=timeout,
+        )
+    else:
+        pool = threadpool.ThreadPool(thread_count, paused=True)
 
-    ui_stop_event = threading.Event()
     ui_kwargs = {
+        'controller': controller,
         'meter': meter,
         'stop_event': ui_stop_event,
         'pool': pool,
@@ -165,6 +1259,53 @@ def threaded_dl(
     ui_thread = threading.Thread(target=ui_thread_func, kwargs=ui_kwargs, daemon=True)
     ui_thread.start()
 
+    if engine == 'async':
+        status = pool.run(urls_filenames)
+    else:
+        status = run_pool(
+            pool,
+            urls_filenames,
+            bytespersecond=bytespersecond,
+            controller=controller,
+            headers=headers,
+            manifest=manifest,
+            meter=meter,
+            metrics=metrics,
+            segment_size=segment_size,
+            timeout=timeout,
+        )
+
+    ui_stop_event.set()
+    ui_thread.join()
+    if metrics_file is not None:
+        metrics.write(metrics_file)
+    return status
+
+def run_pool(
+        pool,
+        urls_filenames,
+        *,
+        bytespersecond,
+        controller,
+        headers,
+        manifest,
+        meter,
+        metrics,
+        segment_size,
+        timeout,
+    ):
+    if segment_size is not None:
+        (urls_filenames, segmented) = plan_segments(
+            pool,
+            urls_filenames,
+            segment_size,
+            headers=headers,
+            manifest=manifest,
+            timeout=timeout,
+        )
+    else:
+        segmented = []
+
     kwargss = []
     for (url, filename) in urls_filenames:
         kwargs = {
@@ -173,12 +1314,52 @@ def threaded_dl(
                 'bytespersecond': bytespersecond,
                 'filename': filename,
                 'headers': headers,
+                'manifest': manifest,
                 'meter': meter,
                 'timeout': timeout,
                 'url': url,
             }
         }
         kwargss.append(kwargs)
+
+    for download in segmented:
+        for (start, end) in list(download.segments):
+            kwargs = {
+                'function': download_segment_job,
+                'kwargs': {
+                    'bytespersecond': bytespersecond,
+                    'download': download,
+                    'end': end,
+                    'headers': headers,
+                    'meter': meter,
+                    'start': start,
+                    'timeout': timeout,
+                }
+            }
+            kwargss.append(kwargs)
+
+    if not kwargss:
+        return 0
+
+    for kwargs in kwargss:
+        job_kwargs = kwargs['kwargs']
+        if metrics is not None:
+            if 'download' in job_kwargs:
+                name = f'{job_kwargs["download"].filename} bytes {job_kwargs["start"]}-{job_kwargs["end"]}'
+                url = job_kwargs['download'].url
+            else:
+                (name, url) = (job_kwargs['filename'], job_kwargs['url'])
+            job_metrics = metrics.add_job(name, url)
+            job_kwargs['meter'] = job_metrics
+            kwargs['kwargs'] = {'wrapped': kwargs['function'], 'job_metrics': job_metrics, **job_kwargs}
+            kwargs['function'] = measured_job
+
+        # The metrics go inside of auto_job so that the time spent waiting for
+        # the controller doesn't count as time to first byte.
+        if controller is not None:
+            kwargs['kwargs'] = {'function': kwargs['function'], 'controller': controller, **kwargs['kwargs']}
+            kwargs['function'] = auto_job
+
     pool.add_many(kwargss)
 
     status = 0
@@ -187,18 +1368,20 @@ def threaded_dl(
             log.error(''.join(traceback.format_exception(None, job.exception, job.exception.__traceback__)))
             status = 1
 
-    ui_stop_event.set()
-    ui_thread.join()
     return status
 
-def ui_thread_func(meter, pool, stop_event):
+def ui_thread_func(meter, pool, stop_event, controller=None):
     if pipeable.stdout_pipe():
         return
 
     while not stop_event.is_set():
         width = shutil.get_terminal_size().columns
         speed = meter.report()[2]
-        message = f'{bytestring.bytestring(speed)}/s | {pool.running_count} threads'
+        if controller is None:
+            threads = pool.running_count
+        else:
+            threads = f'{controller.active}/{controller.limit}'
+        message = f'{bytestring.bytestring(speed)}/s | {threads} threads'
         spaces = ' ' * (width - len(message) - 1)
         pipeable.stderr(message + spaces, end='\r')
 
@@ -215,11 +1398,22 @@ def threaded_dl_argparse(args):
     if bytespersecond is not None:
         bytespersecond = bytestring.parsebytes(bytespersecond)
 
+    segment_size = args.segment_size
+    if segment_size is not None:
+        segment_size = bytestring.parsebytes(segment_size)
+
     return threaded_dl(
         urls,
+        auto=args.auto,
         bytespersecond=bytespersecond,
+        engine=args.engine,
         filename_format=args.filename_format,
         headers=headers,
+        manifest=args.manifest,
+        metrics_file=args.metrics_file,
+        metrics_port=args.metrics_port,
+        per_host=args.per_host,
+        segment_size=segment_size,
         thread_count=args.thread_count,
         timeout=args.timeout,
     )
@@ -239,7 +1433,9 @@ def main(argv):
         'thread_count',
         type=int,
         help='''
-        Integer number of threads to use for downloading.
+        Integer number of threads to use for downloading. With --engine async,
+        this is the number of downloads that can be in flight at once. With
+        --auto, this is the most threads that will be used.
         ''',
     )
     parser.add_argument(
@@ -269,8 +1465,88 @@ def main(argv):
         bytestring.parsebytes to support strings like "1m", "500k", "2 mb", etc.
         ''',
     )
+    parser.add_argument(
+        '--auto',
+        action='store_true',
+        help='''
+        Start with a few threads and adjust the number of active threads as
+        the batch goes, adding more while that makes the download faster and
+        settling where the speed levels off. If the server responds 429 or
+        503, the number of threads is cut in half and the download is retried
+        after a pause.
+        ''',
+    )
+    parser.add_argument(
+        '--engine',
+        choices=['threads', 'async'],
+        default='threads',
+        help='''
+        "threads" downloads each file on a thread of the pool using downloady.
+        "async" downloads them all on one asyncio event loop with pooled
+        keep-alive connections, which handles batches of many thousands of
+        small files with thousands of downloads in flight at once, without
+        needing thousands of threads. The async engine does not resume
+        partial files, does not support --segment_size, and connects directly
+        to every server, ignoring the HTTP_PROXY and HTTPS_PROXY environment
+        variables.
+        ''',
+    )
+    parser.add_argument(
+        '--per_host',
+        type=int,
+        default=None,
+        help='''
+        With --engine async, don't have more than this many downloads in
+        flight to any one host at the same time.
+        ''',
+    )
+    parser.add_argument(
+        '--manifest',
+        default=None,
+        metavar='filepath',
+        help='''
+        Record the state of each download in this sqlite file: its filename,
+        whether it is pending, downloading, done, or failed, how many bytes
+        have been downloaded, the server's ETag, and the error if any.
+        Running the same links again with the same manifest skips the finished
+        files, resumes the partial ones, and retries the failures.
+        ''',
+    )
+    parser.add_argument(
+        '--metrics_file',
+        default=None,
+        metavar='filepath',
+        help='''
+        Every few seconds, write a JSON report to this file with the overall
+        speed, the number of queued, running, finished, and failed jobs, the
+        speed and time to first byte of each host, and the bytes, speed, time
+        to first byte, and retries of each running, failed, and recently
+        finished job.
+        ''',
+    )
+    parser.add_argument(
+        '--metrics_port',
+        type=int,
+        default=None,
+        help='''
+        Serve the same JSON report as --metrics_file at http://127.0.0.1:port
+        for as long as the batch is running.
+        ''',
+    )
+    parser.add_argument(
+        '--segment_size',
+        default=None,
+        help='''
+        Files larger than this are split into segments of this size, which are
+        downloaded at the same time by separate threads using HTTP Range
+        requests, so a few large files can still use all of the threads. Files
+        from servers that do not support ranges are downloaded in one stream
+        as usual. Uses bytestring.parsebytes to support strings like "50m".
+        ''',
+    )
     parser.add_argument(
         '--timeout',
+        type=float,
         default=15,
         help='''
         Integer number of seconds to use as HTTP request timeout for each download.